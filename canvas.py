@@ -0,0 +1,110 @@
+"""The document model, the pixels of an image kept in one RGBA buffer"""
+
+import wx
+
+
+class Canvas:
+    """ A Canvas owns the pixels of an image as one bytearray of RGBA bytes,
+        row after row, and keeps a wx.Image in step with it for display """
+
+    def __init__(self, width, height, data=None):
+        self.width = width
+        self.height = height
+        if data is None:
+            data = bytearray(width * height * 4)
+        self.data = data
+        self.image = wx.Image(width, height)
+        self.image.InitAlpha()
+        # bounding box of the pixels changed since the image was synced
+        self.dirty = (0, 0, width, height)
+
+    @classmethod
+    def from_image(cls, img):
+        """ Make a Canvas holding the pixels of the wx.Image img """
+        (width, height) = (img.GetWidth(), img.GetHeight())
+        rgb = img.GetData()
+        if img.HasAlpha():
+            alpha = img.GetAlpha()
+        else:
+            alpha = b'\xff' * (width * height)
+        data = bytearray(width * height * 4)
+        data[0::4] = rgb[0::3]
+        data[1::4] = rgb[1::3]
+        data[2::4] = rgb[2::3]
+        data[3::4] = alpha
+        return cls(width, height, data)
+
+    def contains(self, x_pos, y_pos):
+        """ Whether (x_pos, y_pos) is a pixel of the canvas """
+        return self.width > x_pos >= 0 and self.height > y_pos >= 0
+
+    def get_pixel(self, x_pos, y_pos):
+        """ The (red, green, blue, alpha) of a pixel, like wx.Image this
+            is all zeros for positions outside the canvas """
+        if not self.contains(x_pos, y_pos):
+            return (0, 0, 0, 0)
+        start = (y_pos * self.width + x_pos) * 4
+        return tuple(self.data[start:start + 4])
+
+    def set_pixel(self, x_pos, y_pos, color):
+        """ Change a pixel to color (red, green, blue, alpha),
+            returns whether the pixel is on the canvas """
+        if not self.contains(x_pos, y_pos):
+            return False
+        start = (y_pos * self.width + x_pos) * 4
+        self.data[start:start + 4] = bytes(color)
+        self.mark_dirty((x_pos, y_pos, 1, 1))
+        return True
+
+    def mark_dirty(self, box=None):
+        """ Note that the pixels in box (x, y, width, height), or all the
+            pixels, changed without going through set_pixel """
+        if box is None:
+            box = (0, 0, self.width, self.height)
+        if self.dirty is not None:
+            (x_0, y_0) = (min(box[0], self.dirty[0]), min(box[1], self.dirty[1]))
+            x_1 = max(box[0] + box[2], self.dirty[0] + self.dirty[2])
+            y_1 = max(box[1] + box[3], self.dirty[1] + self.dirty[3])
+            box = (x_0, y_0, x_1 - x_0, y_1 - y_0)
+        self.dirty = box
+
+    def rows(self):
+        """ The rows of the canvas as memoryviews of RGBA bytes """
+        stride = self.width * 4
+        view = memoryview(self.data)
+        return [view[y_pos * stride:(y_pos + 1) * stride]
+                for y_pos in range(self.height)]
+
+    def to_image(self):
+        """ Copy the dirty part of the buffer into the wx.Image and
+            return the image """
+        if self.dirty is None:
+            return self.image
+        (x_0, y_0, width, height) = self.dirty
+        self.dirty = None
+        if width == self.width and height == self.height:
+            self.image.SetData(self._rgb(self.data))
+            self.image.SetAlpha(bytes(self.data[3::4]))
+            return self.image
+        # whole rows are one run, otherwise copy a run for every row
+        if width == self.width:
+            runs = [(y_0 * width, width * height)]
+        else:
+            runs = [(y_pos * self.width + x_0, width)
+                    for y_pos in range(y_0, y_0 + height)]
+        rgb = memoryview(self.image.GetDataBuffer())
+        alpha = memoryview(self.image.GetAlphaBuffer())
+        for (start, length) in runs:
+            pixels = self.data[start * 4:(start + length) * 4]
+            rgb[start * 3:(start + length) * 3] = self._rgb(pixels)
+            alpha[start:start + length] = pixels[3::4]
+        return self.image
+
+    @classmethod
+    def _rgb(cls, pixels):
+        """ Helper function used by to_image, drops the alpha bytes """
+        rgb = bytearray(len(pixels) // 4 * 3)
+        rgb[0::3] = pixels[0::4]
+        rgb[1::3] = pixels[1::4]
+        rgb[2::3] = pixels[2::4]
+        return rgb
@@ -2,6 +2,32 @@
 
 import wx
 
+# the checkerboard brushes, by (cell size, phase)
+_CHECKERBOARDS = {}
+
+def checkerboard(cell=10, odd=False):
+    """ A brush that tiles the transparency checkerboard, with light grey
+        cells of cell pixels where (x // cell + y // cell) is even, or odd.
+        The tile bitmap is only made once for every cell size """
+    key = (cell, odd)
+    if key not in _CHECKERBOARDS:
+        light = wx.Colour(200, 200, 200, 255)
+        dark = wx.Colour(100, 100, 100, 255)
+        if odd:
+            (light, dark) = (dark, light)
+        tile = wx.Bitmap(2 * cell, 2 * cell)
+        mem_dc = wx.MemoryDC(tile)
+        mem_dc.SetBackground(wx.Brush(dark))
+        mem_dc.Clear()
+        mem_dc.SetPen(wx.TRANSPARENT_PEN)
+        mem_dc.SetBrush(wx.Brush(light))
+        mem_dc.DrawRectangle(0, 0, cell, cell)
+        mem_dc.DrawRectangle(cell, cell, cell, cell)
+        mem_dc.SelectObject(wx.NullBitmap)
+        _CHECKERBOARDS[key] = wx.Brush(tile)
+    return _CHECKERBOARDS[key]
+
+
 class ActiveColor(wx.Control):
     """ ActiveColors shows what color is connected to left and right button"""
 
@@ -21,28 +47,15 @@ class ActiveColor(wx.Control):
     def on_paint(self, event):
         "The actions to take to repaint this area of the screen"
         paint_dc = wx.PaintDC(self)
-        graphics = wx.GraphicsContext.Create(paint_dc)
+        paint_dc.SetPen(wx.TRANSPARENT_PEN)
+        paint_dc.SetBrush(checkerboard(10, odd=True))
+        paint_dc.DrawRectangle(30, 10, 40, 30)
+        paint_dc.DrawRectangle(10, 00, 40, 30)
 
+        graphics = wx.GraphicsContext.Create(paint_dc)
         pen = graphics.CreatePen(wx.Pen(wx.Colour(0, 0, 0, 255)))
         fore = graphics.CreateBrush(wx.Brush(self.foreground))
         back = graphics.CreateBrush(wx.Brush(self.background))
-        light_grey_brush = graphics.CreateBrush(wx.Brush((200, 200, 200, 255)))
-        dark_grey_brush = graphics.CreateBrush(wx.Brush((100, 100, 100, 255)))
-
-        graphics.SetBrush(dark_grey_brush)
-        graphics.DrawRectangle(30, 10, 40, 30)
-        graphics.DrawRectangle(10, 00, 40, 30)
-        graphics.SetBrush(light_grey_brush)
-        graphics.DrawRectangle(10, 00, 10, 10)
-        graphics.DrawRectangle(30, 00, 10, 10)
-        graphics.DrawRectangle(20, 10, 10, 10)
-        graphics.DrawRectangle(40, 10, 10, 10)
-        graphics.DrawRectangle(60, 10, 10, 10)
-        graphics.DrawRectangle(10, 20, 10, 10)
-        graphics.DrawRectangle(30, 20, 10, 10)
-        graphics.DrawRectangle(50, 20, 10, 10)
-        graphics.DrawRectangle(40, 30, 10, 10)
-        graphics.DrawRectangle(60, 30, 10, 10)
 
         graphics.SetPen(pen)
         graphics.SetBrush(back)
@@ -145,17 +158,13 @@ class AlphaControl(ColorControl):
         """ Paint is slightly different as it incorporates the selected color
             mixed with the desired amount of alpha """
         paint_dc = wx.PaintDC(self)
+        paint_dc.SetPen(wx.TRANSPARENT_PEN)
+        paint_dc.SetBrush(checkerboard(10))
+        paint_dc.DrawRectangle(0, 0, 20, 20)
+
         graphics = wx.GraphicsContext.Create(paint_dc)
         none_pen = graphics.CreatePen(wx.Pen(wx.Colour(0, 0, 0, 0)))
-        light_grey_brush = graphics.CreateBrush(wx.Brush((200, 200, 200, 255)))
-        dark_grey_brush = graphics.CreateBrush(wx.Brush((100, 100, 100, 255)))
-
         graphics.SetPen(none_pen)
-        graphics.SetBrush(dark_grey_brush)
-        graphics.DrawRectangle(0, 0, 20, 20)
-        graphics.SetBrush(light_grey_brush)
-        graphics.DrawRectangle(0, 0, 10, 10)
-        graphics.DrawRectangle(10, 10, 10, 10)
 
         clr = getattr(self.window.active_color, self.ground)
         color = (clr[0], clr[1], clr[2], (self.color[3] | 63))
@@ -1,5 +1,18 @@
 "Undo / Redo Command module"
 
+
+def bounding_box(positions):
+    """ The (x, y, width, height) box around a list of (x, y) positions,
+        or None if the list is empty """
+    if not positions:
+        return None
+    x_values = [x_pos for (x_pos, _) in positions]
+    y_values = [y_pos for (_, y_pos) in positions]
+    return (min(x_values), min(y_values),
+            max(x_values) - min(x_values) + 1,
+            max(y_values) - min(y_values) + 1)
+
+
 #pylint: disable-msg=too-few-public-methods
 class PixelMod:
     """ Pixel modification class used by DrawCommand class """
@@ -15,30 +28,43 @@ class DrawCommand:
 
     def __init__(self, target):
         self.pixel_mods = {}
-        self.target = target #for a draw command this is an image
+        self.target = target #for a draw command this is a canvas.Canvas
         self.children = []
         self.parent = None
 
     def add_pixel_mod(self, mod):
-        "Adds a PixelMod to this DrawCommand"
+        """Adds a PixelMod to this DrawCommand,
+           returns whether it was added (the pixel was not modified yet)"""
         if (mod.pos["x"], mod.pos["y"]) not in self.pixel_mods:
             self.pixel_mods[(mod.pos["x"], mod.pos["y"])] = mod
+            return True
+        return False
 
     def invoke(self):
-        "Apply all the pixel modifications"
-        for mod in self.pixel_mods.values():
-            self.set_pixel(mod.pos, mod.new_color)
+        """Apply all the pixel modifications,
+           returns the bounding box of the pixels changed"""
+        return self.apply(self.pixel_mods.values())
+
+    def apply(self, mods):
+        """Apply just the given pixel modifications of this command, such as
+           those added while it is being drawn,
+           returns the bounding box of the pixels changed"""
+        changed = []
+        for mod in mods:
+            if self.set_pixel(mod.pos, mod.new_color):
+                changed.append((mod.pos["x"], mod.pos["y"]))
+        return bounding_box(changed)
 
     def revoke(self):
-        "Remove all the pixel modifications"
+        """Remove all the pixel modifications,
+           returns the bounding box of the pixels changed"""
+        changed = []
         for mod in self.pixel_mods.values():
-            self.set_pixel(mod.pos, mod.old_color)
+            if self.set_pixel(mod.pos, mod.old_color):
+                changed.append((mod.pos["x"], mod.pos["y"]))
+        return bounding_box(changed)
 
     def set_pixel(self, pos, color):
-        """ Helper function to change a single pixel in the image """
-        (red, green, blue, alpha) = color
-        width = self.target.GetWidth()
-        height = self.target.GetHeight()
-        if width > pos["x"] >= 0 and height > pos["y"] >= 0:
-            self.target.SetRGB(pos["x"], pos["y"], red, green, blue)
-            self.target.SetAlpha(pos["x"], pos["y"], alpha)
+        """ Helper function to change a single pixel in the image,
+            returns whether the pixel is in the image """
+        return self.target.set_pixel(pos["x"], pos["y"], color)
@@ -146,8 +146,11 @@ And now, my famous members
 
 __version__ = "0.0.18"
 
+import collections
+import io
 import itertools
 import math
+import os
 import re
 # http://www.python.org/doc/2.4.4/lib/module-operator.html
 import operator
@@ -158,7 +161,6 @@ import warnings
 import zlib
 
 from array import array
-from functools import reduce
 
 try:
     # `cpngfilters` is a Cython module: it must be compiled by
@@ -170,8 +172,17 @@ try:
 except ImportError:
     pass
 
+try:
+    # NumPy is optional.  When it is available (and `cpngfilters` is
+    # not) the filtering functions are replaced by versions that use
+    # it, see `class numpyfilters` (only some of them are vectorized).
+    import numpy
+except ImportError:
+    numpy = None
+
 
-__all__ = ['Image', 'Reader', 'Writer', 'write_chunks', 'from_array']
+__all__ = ['Image', 'Reader', 'Writer', 'write_chunks', 'from_array',
+           'probe']
 
 
 # The PNG signature.
@@ -196,6 +207,123 @@ def isarray(x):
 def tostring(row):
     return row.tobytes()
 
+def _sample_view(row, typecode):
+    """If `row` exposes its samples through the buffer protocol with
+    items of type `typecode` (``'B'`` or ``'H'``), return a flat
+    ``memoryview`` of them, without copying; otherwise return
+    ``None``.  That covers ``bytes``, ``bytearray``, ``memoryview``
+    and ``array`` objects, and C-contiguous NumPy arrays of any shape.
+    NumPy arrays of other integer types are converted, provided their
+    values fit.
+    """
+
+    if numpy is not None and isinstance(row, numpy.ndarray):
+        if row.dtype != numpy.dtype(typecode):
+            info = numpy.iinfo(typecode)
+            if (row.dtype.kind not in 'biu' or
+                row.size and (row.min() < info.min or
+                              row.max() > info.max)):
+                return None
+            row = row.astype(typecode)
+        row = numpy.ascontiguousarray(row)
+    try:
+        view = memoryview(row)
+    except TypeError:
+        return None
+    if view.format != typecode or not view.c_contiguous:
+        return None
+    if view.ndim != 1:
+        view = view.cast('B').cast(typecode)
+    return view
+
+def _sample_array(row, typecode):
+    """Return the samples of `row` as an ``array(typecode)``, copying
+    them directly from its buffer when :func:`_sample_view` allows.
+    """
+
+    view = _sample_view(row, typecode)
+    if view is None:
+        return array(typecode, row)
+    a = array(typecode)
+    a.frombytes(view.cast('B'))
+    return a
+
+def _from_be16(raw):
+    """Convert `raw`, a bytes-like object of big-endian 16-bit
+    values, into an ``array('H')``.
+    """
+
+    a = array('H')
+    a.frombytes(raw)
+    if sys.byteorder == 'little':
+        a.byteswap()
+    return a
+
+def _to_be16(values):
+    """Convert a sequence of 16-bit `values` into bytes, big-endian.
+    The inverse of :func:`_from_be16`.
+    """
+
+    a = _sample_array(values, 'H')
+    if sys.byteorder == 'little':
+        a.byteswap()
+    return a.tobytes()
+
+def _make_sample_tables(bitdepth):
+    """Make the translation tables used by :func:`unpack_samples` and
+    :func:`pack_samples` for the sub-byte `bitdepth`.  There is one
+    pair of tables per sample position within a byte (most
+    significant sample first): the first table maps a byte to the
+    sample at that position; the second maps a sample value to its
+    contribution to the packed byte.
+    """
+
+    mask = 2**bitdepth - 1
+    shifts = [bitdepth * i for i in reversed(range(8//bitdepth))]
+    unpack = [bytes(bytearray((b >> s) & mask for b in range(256)))
+              for s in shifts]
+    pack = [bytes(bytearray(((b & mask) << s) & 0xff for b in range(256)))
+            for s in shifts]
+    return unpack, pack
+
+_sample_tables = dict((bitdepth, _make_sample_tables(bitdepth))
+                      for bitdepth in (1, 2, 4))
+
+def unpack_samples(raw, bitdepth, width):
+    """Unpack a row of bytes, `raw`, holding samples of `bitdepth`
+    bits (1, 2, or 4) into an ``array('B')`` of `width` samples, one
+    per element.  Whole rows are processed at once: each sample
+    position within a byte is extracted with one
+    :meth:`bytes.translate` call into a strided slice of the result.
+    """
+
+    spb = 8 // bitdepth
+    raw = bytes(raw)
+    out = bytearray(len(raw) * spb)
+    for i, table in enumerate(_sample_tables[bitdepth][0]):
+        out[i::spb] = raw.translate(table)
+    del out[width:]
+    return array('B', out)
+
+def pack_samples(values, bitdepth):
+    """Pack a row of sample `values` (each less than
+    ``2**bitdepth``) into bytes, `bitdepth` (1, 2, or 4) bits per
+    sample, most significant sample first, padding the last byte
+    with zero bits.  The inverse of :func:`unpack_samples`.  Returns
+    a :class:`bytes` instance.
+    """
+
+    spb = 8 // bitdepth
+    values = _sample_array(values, 'B').tobytes()
+    values += bytes(-len(values) % spb)
+    # The samples in each position occupy disjoint bits, so the
+    # packed bytes are the bitwise OR of the translated positions,
+    # computed all at once on long integers.
+    packed = 0
+    for i, table in enumerate(_sample_tables[bitdepth][1]):
+        packed |= int.from_bytes(values[i::spb].translate(table), 'big')
+    return packed.to_bytes(len(values) // spb, 'big')
+
 def interleave_planes(ipixels, apixels, ipsize, apsize):
     """
     Interleave (colour) planes, e.g. RGB + A = RGBA.
@@ -226,6 +354,18 @@ def interleave_planes(ipixels, apixels, ipsize, apsize):
         out[i+ipsize:newtotal:newpsize] = apixels[i:atotal:apsize]
     return out
 
+def _interleave_bytes(channels):
+    """Interleave `channels`, a list of equal length byte strings,
+    into a single ``bytearray``: the first byte of each channel, then
+    the second byte of each, and so on.
+    """
+
+    n = len(channels)
+    out = bytearray(n * len(channels[0]))
+    for i, channel in enumerate(channels):
+        out[i::n] = channel
+    return out
+
 def check_palette(palette):
     """Check a palette argument (to the :class:`Writer` class)
     for validity.  Returns the palette as a list if okay; raises an
@@ -317,6 +457,47 @@ class ChunkError(FormatError):
     pass
 
 
+# The zlib compression strategies, by the names that :class:`Writer`
+# accepts for its `strategy` argument.
+_strategies = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+    'rle': zlib.Z_RLE,
+    'fixed': zlib.Z_FIXED,
+}
+
+def _check_strategy(strategy):
+    """Check a `strategy` argument (of :class:`Writer`), a name
+    from `_strategies` or a ``zlib`` constant; return the constant.
+    """
+
+    if strategy in _strategies:
+        return _strategies[strategy]
+    if strategy in _strategies.values():
+        return strategy
+    raise ValueError("strategy must be one of %s" %
+                     ', '.join(sorted(_strategies)))
+
+# Named sets of :class:`Writer` arguments, for example
+# ``Writer(width, height, **profiles['fast'])``.  The ``fast`` profile
+# compresses cheaply, for autosaves and the like.  It leaves the rows
+# unfiltered, so no time goes on filtering, and uses level 3, the
+# highest of zlib's fast levels: on a 1024x1024 RGBA sprite
+# (``pngbench.py``) it takes half the time of the default level 6
+# and writes files smaller than levels 1 and 2 do.
+profiles = {
+    'fast': dict(compression=3),
+}
+
+# The combinations of compression arguments tried by
+# :meth:`Writer.write_optimized`.
+optimize_candidates = [
+    dict(strategy=strategy, compression=level, filter_type=filter_type)
+    for strategy in ['default', 'filtered', 'rle']
+    for level in [6, 9]
+    for filter_type in [0, 1, 'adaptive']]
+
 class Writer:
     """
     PNG encoder in pure Python.
@@ -340,7 +521,10 @@ class Writer:
                  chunk_limit=2**20,
                  x_pixels_per_unit = None,
                  y_pixels_per_unit = None,
-                 unit_is_meter = False):
+                 unit_is_meter = False,
+                 filter_type=0,
+                 compress_workers=1,
+                 strategy='default'):
         """
         Create a PNG encoder object.
 
@@ -381,6 +565,16 @@ class Writer:
         unit_is_meter
           `True` to indicate that the unit (for the `pHYs`
           chunk) is metre.
+        filter_type
+          Scanline filter: 0 (none) to 4 (Paeth), or ``'adaptive'``
+          to choose the best filter for each row; default: 0.
+        compress_workers
+          Number of threads to compress with; 0 means one per CPU;
+          default: 1.
+        strategy
+          zlib compression strategy: ``'default'``, ``'filtered'``,
+          ``'huffman'``, ``'rle'``, or ``'fixed'`` (or the
+          corresponding ``zlib`` constant); default: ``'default'``.
 
         The image size (in pixels) can be specified either by using the
         `width` and `height` arguments, or with the single `size`
@@ -470,6 +664,32 @@ class Writer:
         `chunk_limit` is used to limit the amount of memory used whilst
         compressing the image.  In order to avoid using large amounts of
         memory, multiple ``IDAT`` chunks may be created.
+
+        `filter_type` selects the PNG filter applied to every scanline
+        before compression (see
+        http://www.w3.org/TR/PNG/#9Filter-types ).  Filtering usually
+        makes the image data compress better.  ``'adaptive'`` filters
+        each row with all 5 filter types and keeps the one with the
+        smallest sum of absolute differences (the heuristic suggested
+        by the PNG specification, see :meth:`adaptive_filter`).  This
+        is usually the best choice for photographic images, but costs
+        time, particularly without NumPy.
+
+        When `compress_workers` is more than 1, the image data is
+        compressed in parallel, in the manner of ``pigz``: it is split
+        into blocks that are compressed concurrently (each primed with
+        the end of the previous block, so little compression is lost)
+        and joined into a single ``zlib`` stream.  The result is an
+        ordinary PNG file.  The ``zlib`` module releases the GIL
+        whilst compressing, so this scales with the number of CPUs
+        for large images.
+
+        `strategy` tunes the deflate algorithm to the data (see the
+        ``zlib`` documentation).  ``'rle'`` only looks for runs of
+        one byte, so it suits images filtered with ``filter_type=1``
+        (sub), which turns flat areas into runs of zero bytes.  The
+        ``profiles`` dictionary has ready made sets of arguments, and
+        :meth:`write_optimized` tries many combinations.
         """
 
         # At the moment the `planes` argument is ignored;
@@ -545,6 +765,15 @@ class Writer:
         if bitdepth > 8 and palette:
             raise ValueError(
                 "bit depth must be 8 or less for images with palette")
+        if filter_type not in (0,1,2,3,4,'adaptive'):
+            raise ValueError(
+                "filter_type must be 0 to 4 or 'adaptive'")
+        if not isinteger(compress_workers) or compress_workers < 0:
+            raise ValueError(
+                "compress_workers must be a non-negative integer")
+        if compress_workers == 0:
+            compress_workers = os.cpu_count() or 1
+        strategy = _check_strategy(strategy)
 
         transparent = check_color(transparent, greyscale, 'transparent')
         background = check_color(background, greyscale, 'background')
@@ -568,6 +797,9 @@ class Writer:
         self.x_pixels_per_unit = x_pixels_per_unit
         self.y_pixels_per_unit = y_pixels_per_unit
         self.unit_is_meter = bool(unit_is_meter)
+        self.filter_type = filter_type
+        self.compress_workers = int(compress_workers)
+        self.strategy = strategy
 
         self.color_type = 4*self.alpha + 2*(not greyscale) + 1*self.colormap
         assert self.color_type in (0,2,3,4,6)
@@ -606,6 +838,11 @@ class Writer:
         be written.  Supply the rows in the normal image order;
         the interlacing is carried out internally.
 
+        Rows may be any sequences of integers.  Rows that expose
+        their samples through the buffer protocol (``bytes``,
+        ``memoryview``, ``array``, NumPy arrays) are copied from their
+        buffers, which is much faster.
+
         .. note ::
 
           Interlacing will require the entire image to be in working
@@ -613,8 +850,30 @@ class Writer:
         """
 
         if self.interlace:
+            # Copy the rows into one preallocated buffer, which
+            # :meth:`array_scanlines_interlace` can then take strided
+            # slices from.
             fmt = 'BH'[self.bitdepth > 8]
-            a = array(fmt, itertools.chain(*rows))
+            vpr = self.width * self.planes
+            a = array(fmt, [0]) * (vpr * self.height)
+            nrows = 0
+            for row in rows:
+                if nrows >= self.height:
+                    nrows += 1
+                    continue
+                if not (isarray(row) and row.typecode == fmt):
+                    row = _sample_array(row, fmt)
+                if len(row) != vpr:
+                    raise ValueError(
+                      "row %d has %d values, expected %d" %
+                      (nrows, len(row), vpr))
+                offset = nrows * vpr
+                a[offset:offset+vpr] = row
+                nrows += 1
+            if nrows != self.height:
+                raise ValueError(
+                  "rows supplied (%d) does not match height (%d)" %
+                  (nrows, self.height))
             return self.write_array(outfile, a)
 
         nrows = self.write_passes(outfile, rows)
@@ -623,6 +882,50 @@ class Writer:
               "rows supplied (%d) does not match height (%d)" %
               (nrows, self.height))
 
+    def write_optimized(self, outfile, rows, candidates=None,
+                        workers=None):
+        """Write a PNG image to the output file, trying several
+        combinations of the compression arguments and keeping the one
+        that gives the smallest file.  `rows` are as for :meth:`write`.
+        `candidates` is a list of dictionaries of `compression`,
+        `strategy`, and `filter_type` arguments (see :class:`Writer`);
+        by default, ``optimize_candidates``.  They are tried
+        concurrently on a pool of `workers` processes (by default, one
+        per CPU).
+
+        Returns a list with an entry for each candidate, in order: a
+        copy of its dictionary with ``size``, the size in bytes of the
+        PNG file, and ``seconds``, the time it took to encode, added.
+        """
+
+        import concurrent.futures
+
+        if candidates is None:
+            candidates = optimize_candidates
+        defaults = dict(compression=self.compression,
+                        strategy=self.strategy,
+                        filter_type=self.filter_type)
+        candidates = [dict(defaults, **c) for c in candidates]
+        for c in candidates:
+            _check_strategy(c['strategy'])
+            if c['filter_type'] not in (0,1,2,3,4,'adaptive'):
+                raise ValueError(
+                    "filter_type must be 0 to 4 or 'adaptive'")
+        typecode = 'BH'[self.bitdepth > 8]
+        rows = [_sample_array(row, typecode) for row in rows]
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            jobs = [executor.submit(_encode_candidate, self, rows, c)
+                    for c in candidates]
+            results = [job.result() for job in jobs]
+        report = []
+        best = None
+        for c, (data, seconds) in zip(candidates, results):
+            report.append(dict(c, size=len(data), seconds=seconds))
+            if best is None or len(data) < len(best):
+                best = data
+        outfile.write(best)
+        return report
+
     def write_passes(self, outfile, rows, packed=False):
         """
         Write a PNG image to the output file.
@@ -700,39 +1003,42 @@ class Writer:
             write_chunk(outfile, b'pHYs', struct.pack("!LLB",*tup))
 
         # http://www.w3.org/TR/PNG/#11IDAT
-        if self.compression is not None:
-            compressor = zlib.compressobj(self.compression)
+        level = self.compression
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        if self.compress_workers > 1:
+            compressor = _parallel_compressobj(level,
+                                               self.compress_workers,
+                                               self.strategy)
         else:
-            compressor = zlib.compressobj()
+            compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                          zlib.MAX_WBITS,
+                                          zlib.DEF_MEM_LEVEL,
+                                          self.strategy)
 
         # Choose an extend function based on the bitdepth.  The extend
         # function packs/decomposes the pixel values into bytes and
         # stuffs them onto the data array.
         data = array('B')
         if self.bitdepth == 8 or packed:
-            extend = data.extend
+            # Rows that are buffers of bytes (including NumPy arrays)
+            # are copied directly, without making a Python int for
+            # each sample.
+            def extend(sl):
+                view = _sample_view(sl, 'B')
+                if view is None:
+                    data.extend(sl)
+                else:
+                    data.frombytes(view)
         elif self.bitdepth == 16:
             # Decompose into bytes
             def extend(sl):
-                fmt = '!%dH' % len(sl)
-                data.extend(array('B', struct.pack(fmt, *sl)))
+                data.frombytes(_to_be16(sl))
         else:
             # Pack into bytes
             assert self.bitdepth < 8
-            # samples per byte
-            spb = int(8/self.bitdepth)
             def extend(sl):
-                a = array('B', sl)
-                # Adding padding bytes so we can group into a whole
-                # number of spb-tuples.
-                l = float(len(a))
-                extra = math.ceil(l / float(spb))*spb - l
-                a.extend([0]*int(extra))
-                # Pack into bytes
-                l = group(a, spb)
-                l = [reduce(lambda x,y:
-                                           (x << self.bitdepth) + y, e) for e in l]
-                data.extend(l)
+                data.frombytes(pack_samples(sl, self.bitdepth))
         if self.rescale:
             oldextend = extend
             factor = \
@@ -740,56 +1046,102 @@ class Writer:
             def extend(sl):
                 oldextend([int(round(factor*x)) for x in sl])
 
+        # Choose a filter function.  Each row is extended onto `data`
+        # unfiltered (after a placeholder filter type byte), then
+        # replaced with its filtered version.
+        filter_type = self.filter_type
+        if filter_type:
+            # Filter offset, see :meth:`filter_scanline`.
+            fo = max(1, int(self.psize))
+            if filter_type == 'adaptive':
+                def filter_row(line, prev):
+                    return adaptive_filter(line, fo, prev)
+            else:
+                def filter_row(line, prev):
+                    return filter_scanline(filter_type, line, fo, prev)
+            # "up", "average", and "paeth" refer to the previous row,
+            # but the first row of each reduced pass image has none.
+            # Row numbers (in file order) of the first row of each pass.
+            if self.interlace:
+                heights = [len(range(ystart, self.height, ystep))
+                           for xstart, ystart, xstep, ystep in _adam7
+                           if xstart < self.width]
+            else:
+                heights = [self.height]
+            firstrows = set(itertools.accumulate([0] + heights[:-1]))
+            # The previous unfiltered row, boxed so that `filter_last`
+            # can replace it.
+            previous = [None]
+            def filter_last(i, start):
+                """Filter row `i`, which is at the end of `data`,
+                starting at index `start` (after its filter type byte).
+                """
+                line = data[start:]
+                prev = previous[0]
+                if i in firstrows:
+                    prev = None
+                data[start-1:] = filter_row(line, prev)
+                previous[0] = line
+        else:
+            def filter_last(i, start):
+                pass
+
         # Build the first row, testing mostly to see if we need to
         # changed the extend function to cope with NumPy integer types
         # (they cause our ordinary definition of extend to fail, so we
         # wrap it).  See
         # http://code.google.com/p/pypng/issues/detail?id=44
-        enumrows = enumerate(rows)
-        del rows
-
-        # First row's filter type.
-        data.append(0)
-        # :todo: Certain exceptions in the call to ``.next()`` or the
-        # following try would indicate no row data supplied.
-        # Should catch.
-        i,row = next(enumrows)
         try:
-            # If this fails...
-            extend(row)
-        except:
-            # ... try a version that converts the values to int first.
-            # Not only does this work for the (slightly broken) NumPy
-            # types, there are probably lots of other, unknown, "nearly"
-            # int types it works for.
-            def wrapmapint(f):
-                return lambda sl: f([int(x) for x in sl])
-            extend = wrapmapint(extend)
-            del wrapmapint
-            extend(row)
-
-        for i,row in enumrows:
-            # Add "None" filter type.  Currently, it's essential that
-            # this filter type be used for every scanline as we do not
-            # mark the first row of a reduced pass image; that means we
-            # could accidentally compute the wrong filtered scanline if
-            # we used "up", "average", or "paeth" on such a line.
+            enumrows = enumerate(rows)
+            del rows
+
+            # First row's filter type.
             data.append(0)
-            extend(row)
-            if len(data) > self.chunk_limit:
+            # :todo: Certain exceptions in the call to ``.next()`` or the
+            # following try would indicate no row data supplied.
+            # Should catch.
+            i,row = next(enumrows)
+            try:
+                # If this fails...
+                extend(row)
+            except:
+                # ... try a version that converts the values to int first.
+                # Not only does this work for the (slightly broken) NumPy
+                # types, there are probably lots of other, unknown, "nearly"
+                # int types it works for.
+                def wrapmapint(f):
+                    return lambda sl: f([int(x) for x in sl])
+                extend = wrapmapint(extend)
+                del wrapmapint
+                extend(row)
+            filter_last(i, 1)
+
+            for i,row in enumrows:
+                # Add "None" filter type, replaced by `filter_last` if
+                # another filter type is used.
+                data.append(0)
+                start = len(data)
+                extend(row)
+                filter_last(i, start)
+                if len(data) > self.chunk_limit:
+                    compressed = compressor.compress(tostring(data))
+                    if len(compressed):
+                        write_chunk(outfile, b'IDAT', compressed)
+                    # Because of our very witty definition of ``extend``,
+                    # above, we must re-use the same ``data`` object.  Hence
+                    # we use ``del`` to empty this one, rather than create a
+                    # fresh one (which would be my natural FP instinct).
+                    del data[:]
+            if len(data):
                 compressed = compressor.compress(tostring(data))
-                if len(compressed):
-                    write_chunk(outfile, b'IDAT', compressed)
-                # Because of our very witty definition of ``extend``,
-                # above, we must re-use the same ``data`` object.  Hence
-                # we use ``del`` to empty this one, rather than create a
-                # fresh one (which would be my natural FP instinct).
-                del data[:]
-        if len(data):
-            compressed = compressor.compress(tostring(data))
-        else:
-            compressed = b''
-        flushed = compressor.flush()
+            else:
+                compressed = b''
+            flushed = compressor.flush()
+        finally:
+            # Also when rows fail part way: release the compression
+            # threads and the blocks queued for them.
+            if isinstance(compressor, _parallel_compressobj):
+                compressor.close()
         if len(compressed) or len(flushed):
             write_chunk(outfile, b'IDAT', compressed + flushed)
         # http://www.w3.org/TR/PNG/#11IEND
@@ -877,18 +1229,23 @@ class Writer:
         # Values per row
         vpr = self.width * self.planes
         row_bytes = vpr
+        def read(y):
+            data = infile.read(row_bytes)
+            if len(data) < row_bytes:
+                raise FormatError(
+                  'Pixel data ends after %d of %d rows.' % (y, self.height))
+            return data
         if self.bitdepth > 8:
             assert self.bitdepth == 16
             row_bytes *= 2
-            fmt = '>%dH' % vpr
-            def line():
-                return array('H', struct.unpack(fmt, infile.read(row_bytes)))
+            def line(y):
+                return _from_be16(read(y))
         else:
-            def line():
-                scanline = array('B', infile.read(row_bytes))
+            def line(y):
+                scanline = array('B', read(y))
                 return scanline
         for y in range(self.height):
-            yield line()
+            yield line(y)
 
     def array_scanlines(self, pixels):
         """
@@ -917,6 +1274,20 @@ class Writer:
         fmt = 'BH'[self.bitdepth > 8]
         # Value per row
         vpr = self.width * self.planes
+        if (numpy is not None and isarray(pixels) and
+            len(pixels) == vpr * self.height):
+            # View the whole image as a (height, width, planes) block;
+            # each pass is then one strided slice of it.
+            image = numpy.frombuffer(pixels, dtype=pixels.typecode)
+            image = image.reshape(self.height, self.width, self.planes)
+            for xstart, ystart, xstep, ystep in _adam7:
+                if xstart >= self.width:
+                    continue
+                reduced = numpy.ascontiguousarray(
+                  image[ystart::ystep, xstart::xstep])
+                for row in reduced:
+                    yield array(pixels.typecode, row.tobytes())
+            return
         for xstart, ystart, xstep, ystep in _adam7:
             if xstart >= self.width:
                 continue
@@ -940,6 +1311,25 @@ class Writer:
                             pixels[offset+i:end_offset:skip]
                     yield row
 
+def _encode_candidate(writer, rows, options):
+    """Encode `rows` with a copy of `writer` that uses the
+    compression `options` (for :meth:`Writer.write_optimized`).
+    Returns (*PNG data*, *seconds*).
+    """
+
+    import copy
+    import time
+
+    start = time.time()
+    writer = copy.copy(writer)
+    writer.compression = options['compression']
+    writer.strategy = _check_strategy(options['strategy'])
+    writer.filter_type = options['filter_type']
+    writer.compress_workers = 1
+    out = io.BytesIO()
+    writer.write(out, rows)
+    return out.getvalue(), time.time() - start
+
 def write_chunk(outfile, tag, data=b''):
     """
     Write a PNG chunk to the output file, including length and
@@ -955,6 +1345,133 @@ def write_chunk(outfile, tag, data=b''):
     checksum &= 2**32-1
     outfile.write(struct.pack("!I", checksum))
 
+def _adler32_combine(adler1, adler2, len2):
+    """Combine the Adler-32 checksums of two byte strings into the
+    checksum of their concatenation; `len2` is the length of the second
+    string.  The same as ``adler32_combine`` in the zlib library.
+    """
+
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = rem * sum1
+    sum1 += (adler2 & 0xffff) + base - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + base - rem
+    return (sum1 % base) | ((sum2 % base) << 16)
+
+def _deflate_block(block, zdict, level, last,
+                   strategy=zlib.Z_DEFAULT_STRATEGY):
+    """Compress `block` as a raw deflate stream, with the preceding
+    data `zdict` (if any) as its dictionary.  The stream is ended if
+    `last` is true, otherwise it is brought to a byte boundary with a
+    full flush, so that the next block can simply be appended.  Returns
+    (*compressed*, *adler32 of block*).
+    """
+
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                      strategy, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                      strategy)
+    out = compressor.compress(block)
+    out += compressor.flush((zlib.Z_FULL_FLUSH, zlib.Z_FINISH)[last])
+    return out, zlib.adler32(block)
+
+class _parallel_compressobj:
+    """
+    Work-alike for the ``zlib.compressobj`` used to compress ``IDAT``
+    data, that compresses on a pool of threads (see the
+    `compress_workers` argument of :class:`Writer`).  The data is cut
+    into blocks which are compressed independently, each using the
+    last 32 KiB of the previous block as a dictionary; the zlib header
+    and the combined Adler-32 checksum are added here.
+    """
+
+    # Size of the blocks that are compressed concurrently.
+    blocksize = 2**17
+    # Size of the deflate window, and so of the useful dictionary.
+    window = 2**15
+
+    def __init__(self, level, workers, strategy=zlib.Z_DEFAULT_STRATEGY):
+        import concurrent.futures
+
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        self.level = level
+        self.workers = workers
+        self.strategy = strategy
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        # http://www.w3.org/TR/PNG/#10CompressionFM and RFC 1950.
+        # The FLEVEL bits are as zlib would set them.
+        if level == zlib.Z_DEFAULT_COMPRESSION:
+            level = 6
+        flevel = (level >= 2) + (level >= 6) + (level >= 7)
+        header = (0x78 << 8) + (flevel << 6)
+        header += 31 - header % 31
+        self.header = struct.pack('!H', header)
+        # Data not yet submitted.
+        self.pending = bytearray()
+        # The dictionary for the next block.
+        self.zdict = b''
+        # (job, length) for each block submitted, in order.
+        self.jobs = collections.deque()
+        self.adler = zlib.adler32(b'')
+
+    def submit(self, block, last=False):
+        job = self.executor.submit(_deflate_block, block, self.zdict,
+                                   self.level, last, self.strategy)
+        self.jobs.append((job, len(block)))
+        self.zdict = block[-self.window:]
+
+    def collect(self, wait=False):
+        """Return the compressed data of the leading finished blocks
+        (or, if `wait` is true, of all blocks).  Also waits, so as to
+        limit the amount of data in flight.
+        """
+
+        out = []
+        while self.jobs and (wait or self.jobs[0][0].done() or
+                             len(self.jobs) > 2*self.workers):
+            job, length = self.jobs.popleft()
+            compressed, adler = job.result()
+            self.adler = _adler32_combine(self.adler, adler, length)
+            out.append(compressed)
+        if out and self.header:
+            out.insert(0, self.header)
+            self.header = b''
+        return b''.join(out)
+
+    def compress(self, data):
+        self.pending.extend(data)
+        blocksize = self.blocksize
+        i = 0
+        while len(self.pending) - i >= blocksize:
+            self.submit(bytes(self.pending[i:i+blocksize]))
+            i += blocksize
+        del self.pending[:i]
+        return self.collect()
+
+    def flush(self):
+        self.submit(bytes(self.pending), last=True)
+        self.pending = bytearray()
+        out = self.collect(wait=True)
+        self.close()
+        return out + struct.pack('!I', self.adler & 0xffffffff)
+
+    def close(self):
+        """Shut down the thread pool, abandoning any blocks not yet
+        compressed.  Called by :meth:`flush`, and by
+        :meth:`Writer.write_passes` when writing fails part way.
+        """
+
+        for job, length in self.jobs:
+            job.cancel()
+        self.jobs.clear()
+        self.executor.shutdown()
+
 def write_chunks(out, chunks):
     """Create a PNG file by writing out the chunks."""
 
@@ -974,6 +1491,13 @@ def filter_scanline(type, line, fo, prev=None):
 
     assert 0 <= type < 5
 
+    if numpy is not None:
+        x = numpy.array(line, dtype=numpy.int16)
+        out = array('B', [type])
+        out.frombytes(_numpy_filter(type, x, _numpy_prev(x, prev), fo)
+                      .astype(numpy.uint8).tobytes())
+        return out
+
     # The output array.  Which, pathetically, we extend one-byte at a
     # time (fortunately this is linear).
     out = array('B', [type])
@@ -1048,11 +1572,153 @@ def filter_scanline(type, line, fo, prev=None):
         paeth()
     return out
 
+def _numpy_prev(x, prev):
+    """The previous scanline `prev` as a NumPy ``int16`` array like
+    `x`, the current one; all 0 when there is none, as for the
+    reconstruction.
+    """
+
+    if prev:
+        return numpy.array(prev, dtype=numpy.int16)
+    return numpy.zeros_like(x)
+
+def _numpy_filter(type, x, b, fo):
+    """Apply filter `type` to the scanline `x`, given the previous
+    scanline `b`, both NumPy ``int16`` arrays (see
+    :meth:`filter_scanline`).  Only what that filter type needs is
+    computed.  Returns an ``int16`` array, still to be wrapped modulo
+    256.
+    """
+
+    if type == 0:
+        return x
+    if type == 2:
+        return x - b
+    # a is the byte to the left of x.
+    a = numpy.zeros_like(x)
+    a[fo:] = x[:-fo]
+    if type == 1:
+        return x - a
+    if type == 3:
+        return x - ((a + b) >> 1)
+    # c is the byte to the left of b.
+    c = numpy.zeros_like(x)
+    c[fo:] = b[:-fo]
+    # http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
+    p = a + b - c
+    pa = numpy.abs(p - a)
+    pb = numpy.abs(p - b)
+    pc = numpy.abs(p - c)
+    pr = numpy.where((pa <= pb) & (pa <= pc), a, numpy.where(pb <= pc, b, c))
+    return x - pr
+
+def _numpy_filter_candidates(line, fo, prev):
+    """Apply all 5 filter types to a scanline.  The arguments are as
+    for :meth:`filter_scanline`; the result is a 5 row NumPy ``uint8``
+    array, row *n* being the scanline filtered with filter type *n*.
+    """
+
+    x = numpy.array(line, dtype=numpy.int16)
+    b = _numpy_prev(x, prev)
+    out = numpy.empty((5, len(x)), dtype=numpy.int16)
+    for type in range(5):
+        out[type] = _numpy_filter(type, x, b, fo)
+    # Casting wraps modulo 256.
+    return out.astype(numpy.uint8)
+
+# Sum of absolute differences score for each filtered byte value
+# (considered as a signed byte).  See :meth:`adaptive_filter`.
+_sad = [min(v, 256 - v) for v in range(256)]
+
+def adaptive_filter(line, fo, prev=None):
+    """Filter a scanline using the filter type that makes it most
+    compressible, according to the heuristic suggested by the PNG
+    specification: the filter type with the smallest sum of absolute
+    differences, treating each filtered byte as a signed value.  See
+    http://www.w3.org/TR/PNG/#12Filter-selection .
+
+    The arguments and the result are as for :meth:`filter_scanline`
+    (the first byte of the result is the filter type chosen).  When
+    scores are equal, the lowest filter type wins.
+    """
+
+    if numpy is not None:
+        candidates = _numpy_filter_candidates(line, fo, prev)
+        scores = numpy.abs(candidates.view(numpy.int8).astype(numpy.int32))
+        type = int(numpy.argmin(scores.sum(axis=1)))
+        out = array('B', [type])
+        out.frombytes(candidates[type].tobytes())
+        return out
+
+    best = None
+    for type in range(5):
+        out = filter_scanline(type, line, fo, prev)
+        # Skip the filter type byte.
+        score = sum(map(_sad.__getitem__, out[1:]))
+        if best is None or score < best[0]:
+            best = (score, out)
+    return best[1]
+
 
 # Regex for decoding mode string
 RegexModeDecode = re.compile("(LA?|RGBA?);?([0-9]*)", flags=re.IGNORECASE)
 
-def from_array(a, mode=None, info={}):
+def _index_colours(rows, width, alpha):
+    """Convert an 8-bit RGB or RGBA image, given as a list of rows of
+    bytes, to a colour mapped one.  Returns a (*palette*, *bitdepth*,
+    *rows*) triple suitable for :class:`Writer`, with the smallest
+    valid bit depth, or ``None`` if the image has more than 256
+    colours.  Palette entries that are not opaque come first (as
+    4-tuples), so that the ``tRNS`` chunk is as short as possible.
+    """
+
+    data = b''.join(rows)
+    if not alpha:
+        # Widen to RGBA so that each pixel is one 32-bit integer.
+        rgba = bytearray(b'\xff') * (len(data) // 3 * 4)
+        for i in range(3):
+            rgba[i::4] = data[i::3]
+        data = bytes(rgba)
+    if numpy is not None:
+        pixels = numpy.frombuffer(data, dtype=numpy.uint32)
+        colours, indexes = numpy.unique(pixels, return_inverse=True)
+        if len(colours) > 256:
+            return None
+        colours = colours.tolist()
+    else:
+        pixels = array('I' if array('I').itemsize == 4 else 'L')
+        pixels.frombytes(data)
+        colours = set()
+        # Count the colours a row at a time, giving up as soon as
+        # there are too many.
+        for i in range(0, len(pixels), width):
+            colours.update(pixels[i:i+width])
+            if len(colours) > 256:
+                return None
+        colours = sorted(colours)
+    entries = [tuple(bytearray(c.to_bytes(4, sys.byteorder)))
+               for c in colours]
+    order = sorted(range(len(entries)),
+                   key=lambda i: (entries[i][3] == 255, entries[i]))
+    palette = [entries[i][:3] if entries[i][3] == 255 else entries[i]
+               for i in order]
+    # Where each colour (in `colours` order) ends up in the palette.
+    remap = array('B', [0]) * len(order)
+    for index, i in enumerate(order):
+        remap[i] = index
+    if numpy is not None:
+        indexes = numpy.frombuffer(remap, dtype=numpy.uint8)[indexes]
+        indexes = array('B', indexes.tobytes())
+    else:
+        lookup = dict(zip(colours, remap))
+        indexes = array('B', map(lookup.__getitem__, pixels))
+    bitdepth = 1
+    while 2**bitdepth < len(palette):
+        bitdepth *= 2
+    rows = [indexes[i:i+width] for i in range(0, len(indexes), width)]
+    return palette, bitdepth, rows
+
+def from_array(a, mode=None, info={}, indexed=False):
     """Create a PNG :class:`Image` object from a 2- or 3-dimensional
     array.  One application of this function is easy PIL-style saving:
     ``png.from_array(pixels, 'L').save('foo.png')``.
@@ -1127,6 +1793,16 @@ def from_array(a, mode=None, info={}):
     For example, if the *info* dictionary has a ``greyscale`` key then
     this must be true when mode is ``'L'`` or ``'LA'`` and false when
     mode is ``'RGB'`` or ``'RGBA'``.
+
+    When *indexed* is true, an 8-bit ``'RGB'`` or ``'RGBA'`` image
+    that uses no more than 256 distinct colours is saved as a colour
+    mapped image instead: a ``PLTE`` chunk (and a ``tRNS`` chunk for
+    any colours that are not opaque) and pixels at the smallest bit
+    depth (1, 2, 4, or 8) that can index the palette.  That is often
+    a fraction of the size.  Images with more colours are saved as
+    usual.  The whole image is read into memory to count the colours.
+    (*indexed* is ignored when *info* has a ``transparent``,
+    ``background``, or ``palette`` entry.)
     """
 
     # We abuse the *info* parameter by modifying it.  Take a copy here.
@@ -1207,8 +1883,13 @@ def from_array(a, mode=None, info={}):
         info['width'] = width
 
     if threed:
-        # Flatten the threed rows
-        a = (itertools.chain.from_iterable(x) for x in a)
+        # Flatten the threed rows.  NumPy rows stay arrays, so that
+        # the Writer can copy their buffers.
+        def flatten(x):
+            if numpy is not None and isinstance(x, numpy.ndarray):
+                return x.reshape(-1)
+            return itertools.chain.from_iterable(x)
+        a = map(flatten, a)
 
     if 'bitdepth' not in info:
         try:
@@ -1231,6 +1912,16 @@ def from_array(a, mode=None, info={}):
                 bitdepth = 8 * dtype.itemsize
         info['bitdepth'] = bitdepth
 
+    if (indexed and info['bitdepth'] == 8 and not info['greyscale'] and
+        not set(info) & set(['transparent', 'background', 'palette'])):
+        a = [_sample_array(row, 'B') for row in a]
+        result = _index_colours([row.tobytes() for row in a],
+                                info['width'], info['alpha'])
+        if result is not None:
+            info['palette'], info['bitdepth'], a = result
+            info['alpha'] = False
+            info.pop('planes', None)
+
     for thing in ["width", "height", "bitdepth", "greyscale", "alpha"]:
         assert thing in info
 
@@ -1282,7 +1973,9 @@ class Image:
 
 class _readable:
     """
-    A simple file-like interface for strings and arrays.
+    A simple file-like interface for strings and arrays.  When `buf`
+    is a ``memoryview``, :meth:`read` returns ``memoryview`` slices of
+    it, without copying.
     """
 
     def __init__(self, buf):
@@ -1292,10 +1985,38 @@ class _readable:
     def read(self, n):
         r = self.buf[self.offset:self.offset+n]
         if isarray(r):
-            r = r.tostring()
+            r = tostring(r)
         self.offset += n
         return r
 
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.offset
+        elif whence == 2:
+            offset += len(self.buf)
+        self.offset = offset
+        return offset
+
+    def tell(self):
+        return self.offset
+
+def _mmap_file(filename):
+    """Memory map a file for reading, returning a ``memoryview`` of
+    it.
+    """
+
+    import mmap
+
+    with open(filename, "rb") as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file cannot be mapped.
+            return memoryview(b'')
+    # The map stays valid after the file is closed; it is unmapped
+    # when the last view of it is garbage collected.
+    return memoryview(m)
+
 try:
     str(b'dummy', 'ascii')
 except TypeError:
@@ -1304,12 +2025,44 @@ else:
     def as_str(x):
         return str(x, 'ascii')
 
+def _chunk_crc(type, data):
+    """Compute the checksum of a chunk, as its 4 byte (big-endian)
+    encoding.
+    """
+
+    verify = zlib.crc32(type)
+    verify = zlib.crc32(data, verify)
+    # Whether the output from zlib.crc32 is signed or not varies
+    # according to hideous implementation details, see
+    # http://bugs.python.org/issue1202 .
+    # We coerce it to be positive here (in a way which works on
+    # Python 2.3 and older).
+    verify &= 2**32 - 1
+    return struct.pack('!I', verify)
+
+def _check_chunk_crc(type, checksum, verify, lenient):
+    """Compare a chunk's `checksum` with the computed one, `verify`.
+    A mismatch raises :class:`ChunkError` or, if `lenient` is true,
+    issues a warning.
+    """
+
+    if checksum != verify:
+        (a, ) = struct.unpack('!I', checksum)
+        (b, ) = struct.unpack('!I', verify)
+        message = "Checksum error in %s chunk: 0x%08X != 0x%08X." % (type, a, b)
+        if lenient:
+            warnings.warn(message, RuntimeWarning)
+        else:
+            raise ChunkError(message)
+
 class Reader:
     """
     PNG decoder in pure Python.
     """
 
-    def __init__(self, _guess=None, **kw):
+    def __init__(self, _guess=None, mmap=False,
+                 decompress_window=2**16, max_decoded=None,
+                 trusted=False, **kw):
         """
         Create a PNG decoder object.
 
@@ -1324,11 +2077,55 @@ class Reader:
         bytes
           ``array`` or ``string`` with PNG data.
 
+        Options, in addition to the above:
+
+        mmap
+          Memory map the file (`filename` only).
+        decompress_window
+          Most bytes to decompress at a time; default: 65536.
+        max_decoded
+          Refuse images whose decompressed data would be larger than
+          this many bytes; default: no limit.
+        trusted
+          Verify chunk checksums in the background; default: False.
+
+        When `mmap` is true the file is memory mapped, rather than read,
+        and chunks are parsed in place: the data returned by
+        :meth:`chunk` is a ``memoryview`` of the mapped file, and
+        checksums and decompression work on that directly, so the
+        ``IDAT`` data is never copied.  Reading a large image then needs
+        little more memory than the decoded pixels.
+
+        Image data is decompressed incrementally, at most
+        `decompress_window` bytes at a time, however large the ``IDAT``
+        chunks are, so streaming the rows of a straightlaced image
+        uses a constant amount of memory.  The size of the decompressed
+        data follows from the ``IHDR`` chunk; decompression stops with
+        a :class:`FormatError` as soon as more data than that appears
+        (as it would from a "decompression bomb").  `max_decoded`
+        additionally limits the size of acceptable images.
+
+        When `trusted` is true, for files that are not expected to be
+        corrupt, :meth:`chunk` returns each chunk's data straight away
+        and its checksum is verified on a background thread instead.
+        A mismatch is then reported (as an exception, or a warning
+        when reading leniently) once all the rows returned by
+        :meth:`read` (or the methods based on it) have been consumed,
+        or the row iterator is closed early, or by an explicit call
+        to :meth:`verify_deferred`.
         """
         if ((_guess is not None and len(kw) != 0) or
             (_guess is None and len(kw) != 1)):
             raise TypeError("Reader() takes exactly 1 argument")
 
+        self.decompress_window = decompress_window
+        self.max_decoded = max_decoded
+        self.trusted = trusted
+        # For `trusted` reading: a (type, checksum, future) triple for
+        # each chunk whose checksum is being computed, and the thread
+        # pool computing them.
+        self.deferred = []
+        self.crc_executor = None
         # Will be the first 8 bytes, later on.  See validate_signature.
         self.signature = None
         self.transparent = None
@@ -1346,7 +2143,12 @@ class Reader:
             elif hasattr(_guess, 'read'):
                 kw["file"] = _guess
 
-        if "filename" in kw:
+        if mmap and "filename" not in kw:
+            raise TypeError("mmap requires a filename")
+
+        if "filename" in kw and mmap:
+            self.file = _readable(_mmap_file(kw["filename"]))
+        elif "filename" in kw:
             self.file = open(kw["filename"], "rb")
         elif "file" in kw:
             self.file = kw["file"]
@@ -1390,25 +2192,35 @@ class Reader:
                 raise ChunkError('Chunk %s too short for checksum.' % type)
             if seek and type != seek:
                 continue
-            verify = zlib.crc32(type)
-            verify = zlib.crc32(data, verify)
-            # Whether the output from zlib.crc32 is signed or not varies
-            # according to hideous implementation details, see
-            # http://bugs.python.org/issue1202 .
-            # We coerce it to be positive here (in a way which works on
-            # Python 2.3 and older).
-            verify &= 2**32 - 1
-            verify = struct.pack('!I', verify)
-            if checksum != verify:
-                (a, ) = struct.unpack('!I', checksum)
-                (b, ) = struct.unpack('!I', verify)
-                message = "Checksum error in %s chunk: 0x%08X != 0x%08X." % (type, a, b)
-                if lenient:
-                    warnings.warn(message, RuntimeWarning)
-                else:
-                    raise ChunkError(message)
+            if self.trusted:
+                if self.crc_executor is None:
+                    import concurrent.futures
+                    self.crc_executor = \
+                      concurrent.futures.ThreadPoolExecutor(1)
+                self.deferred.append((type, checksum,
+                  self.crc_executor.submit(_chunk_crc, type, data)))
+            else:
+                _check_chunk_crc(type, checksum, _chunk_crc(type, data),
+                                 lenient)
             return type, data
 
+    def verify_deferred(self, lenient=False):
+        """Wait for the checksums of the chunks read so far in
+        `trusted` mode, and check them.  A mismatch raises
+        :class:`ChunkError`, or if `lenient` is true, issues a warning.
+        Does nothing if no checksums are outstanding.
+        """
+
+        deferred = self.deferred
+        self.deferred = []
+        try:
+            for type, checksum, job in deferred:
+                _check_chunk_crc(type, checksum, job.result(), lenient)
+        finally:
+            if self.crc_executor is not None:
+                self.crc_executor.shutdown()
+                self.crc_executor = None
+
     def chunks(self):
         """Return an iterator that will yield each chunk as a
         (*chunktype*, *content*) pair.
@@ -1420,6 +2232,52 @@ class Reader:
             if t == b'IEND':
                 break
 
+    def index(self):
+        """Scan the headers of every chunk in the file, seeking over
+        the chunk data, and return a list of (*offset*, *length*,
+        *type*) triples, one per chunk in file order.  *offset* is the
+        position in the file of the chunk's data (which is followed by
+        its 4 byte checksum), *length* its length, and *type* the
+        chunk's type as a byte string.  So the ``IDAT`` entries give
+        the spans of the compressed image data.
+
+        No chunk data is read and no checksums are verified.  The
+        input must support ``seek`` and ``tell``; its position is
+        restored afterwards, so the reader can be used as normal.
+        """
+
+        position = self.file.tell()
+        size = self.file.seek(0, 2)
+        self.file.seek(0)
+        if self.file.read(8) != _signature:
+            self.file.seek(position)
+            raise FormatError("PNG file has invalid signature.")
+        index = []
+        try:
+            while True:
+                x = self.file.read(8)
+                if not x:
+                    break
+                if len(x) != 8:
+                    raise FormatError(
+                      'End of file whilst reading chunk length and type.')
+                length, type = struct.unpack('!I4s', x)
+                if length > 2**31-1:
+                    raise FormatError(
+                      'Chunk %s is too large: %d.' % (type, length))
+                offset = self.file.tell()
+                if offset + length + 4 > size:
+                    raise ChunkError(
+                      'Chunk %s too short for required %i octets.'
+                      % (type, length))
+                index.append((offset, length, type))
+                if type == b'IEND':
+                    break
+                self.file.seek(length + 4, 1)
+        finally:
+            self.file.seek(position)
+        return index
+
     def undo_filter(self, filter_type, scanline, previous):
         """Undo the filter for a scanline.  `scanline` is a sequence of
         bytes that does not include the initial filter type byte.
@@ -1544,7 +2402,13 @@ class Reader:
         # writes to the output array randomly (well, not quite), so the
         # entire output array must be in memory.
         fmt = 'BH'[self.bitdepth > 8]
-        a = array(fmt, [0]*vpr*self.height)
+        a = array(fmt, [0]) * (vpr * self.height)
+        if numpy is not None:
+            # Each pass is reconstructed into its own contiguous buffer
+            # and then stored with one strided assignment into a
+            # (height, width, planes) view of the result.
+            image = numpy.frombuffer(a, dtype=fmt)
+            image = image.reshape(self.height, self.width, self.planes)
         source_offset = 0
 
         for xstart, ystart, xstep, ystep in _adam7:
@@ -1558,7 +2422,12 @@ class Reader:
             ppr = int(math.ceil((self.width-xstart)/float(xstep)))
             # Row size in bytes for this pass.
             row_size = int(math.ceil(self.psize * ppr))
-            for y in range(ystart, self.height, ystep):
+            if numpy is not None:
+                # Values per row (reduced pass image)
+                pvpr = ppr * self.planes
+                nrows = len(range(ystart, self.height, ystep))
+                reduced = array(fmt, [0]) * (pvpr * nrows)
+            for i, y in enumerate(range(ystart, self.height, ystep)):
                 filter_type = raw[source_offset]
                 source_offset += 1
                 scanline = raw[source_offset:source_offset+row_size]
@@ -1566,7 +2435,9 @@ class Reader:
                 recon = self.undo_filter(filter_type, scanline, recon)
                 # Convert so that there is one element per pixel value
                 flat = self.serialtoflat(recon, ppr)
-                if xstep == 1:
+                if numpy is not None:
+                    reduced[i*pvpr:(i+1)*pvpr] = flat
+                elif xstep == 1:
                     assert xstart == 0
                     offset = y * vpr
                     a[offset:offset+vpr] = flat
@@ -1577,36 +2448,53 @@ class Reader:
                     for i in range(self.planes):
                         a[offset+i:end_offset:skip] = \
                             flat[i::self.planes]
+            if numpy is not None:
+                image[ystart::ystep, xstart::xstep] = numpy.frombuffer(
+                  reduced, dtype=fmt).reshape(nrows, ppr, self.planes)
         return a
 
-    def iterboxed(self, rows):
+    def decompressed_size(self):
+        """The size, in bytes, of the image data once decompressed (but
+        still filtered): every scanline of every pass, each with its
+        filter type byte.  The ``IHDR`` chunk must have been processed.
+        """
+
+        if not self.interlace:
+            return self.height * (self.row_bytes + 1)
+        size = 0
+        for xstart, ystart, xstep, ystep in _adam7:
+            if xstart >= self.width:
+                continue
+            # Pixels per row (reduced pass image)
+            ppr = int(math.ceil((self.width-xstart)/float(xstep)))
+            row_size = int(math.ceil(self.psize * ppr))
+            size += len(range(ystart, self.height, ystep)) * (row_size + 1)
+        return size
+
+    def iterboxed(self, rows, copy=True):
         """Iterator that yields each scanline in boxed row flat pixel
         format.  `rows` should be an iterator that yields the bytes of
         each row in turn.
+
+        When `copy` is false, rows that need no conversion (bit depth
+        8) are yielded as they are, rather than copied; see the
+        `reuse_rows` argument of :meth:`read`.
         """
 
         def asvalues(raw):
             """Convert a row of raw bytes into a flat row.  Result will
             be a freshly allocated object, not shared with
-            argument.
+            argument (unless `copy` is false).
             """
 
             if self.bitdepth == 8:
+                if not copy:
+                    return raw
                 return array('B', raw)
             if self.bitdepth == 16:
-                raw = tostring(raw)
-                return array('H', struct.unpack('!%dH' % (len(raw)//2), raw))
+                return _from_be16(raw)
             assert self.bitdepth < 8
-            width = self.width
-            # Samples per byte
-            spb = 8//self.bitdepth
-            out = array('B')
-            mask = 2**self.bitdepth - 1
-            shifts = [self.bitdepth * i
-                for i in reversed(list(range(spb)))]
-            for o in raw:
-                out.extend([mask&(o>>i) for i in shifts])
-            return out[:width]
+            return unpack_samples(raw, self.bitdepth, self.width)
 
         return map(asvalues, rows)
 
@@ -1618,23 +2506,18 @@ class Reader:
         if self.bitdepth == 8:
             return bytes
         if self.bitdepth == 16:
-            bytes = tostring(bytes)
-            return array('H',
-              struct.unpack('!%dH' % (len(bytes)//2), bytes))
+            return _from_be16(bytes)
         assert self.bitdepth < 8
         if width is None:
             width = self.width
-        # Samples per byte
-        spb = 8//self.bitdepth
+        # Bytes per row; `bytes` may hold several rows.
+        row_bytes = (width * self.bitdepth + 7) // 8
+        if len(bytes) <= row_bytes:
+            return unpack_samples(bytes, self.bitdepth, width)
         out = array('B')
-        mask = 2**self.bitdepth - 1
-        shifts = list(map(self.bitdepth.__mul__, reversed(list(range(spb)))))
-        l = width
-        for o in bytes:
-            out.extend([(mask&(o>>s)) for s in shifts][:l])
-            l -= spb
-            if l <= 0:
-                l = width
+        for i in range(0, len(bytes), row_bytes):
+            out.extend(unpack_samples(bytes[i:i+row_bytes],
+                                      self.bitdepth, width))
         return out
 
     def iterstraight(self, raw):
@@ -1642,29 +2525,49 @@ class Reader:
         each row in serialised format (as a sequence of bytes).
         Assumes input is straightlaced.  `raw` should be an iterable
         that yields the raw bytes in chunks of arbitrary size.
+
+        Rows are reconstructed, in place, in one of two buffers that
+        are used in turn (the other holds the previous row), so each
+        row yielded is only valid until the next row is requested.
+        Copy it to keep it.
         """
 
         # length of row, in bytes
         rb = self.row_bytes
-        a = array('B')
-        # The previous (reconstructed) scanline.  None indicates first
-        # line of image.
-        recon = None
+        # Bytes received but not yet used.  The unused bytes start at
+        # index `start`; the used ones are only deleted once per chunk
+        # of input, when there are less than a row's worth left.
+        a = bytearray()
+        start = 0
+        # The row being reconstructed, and the previous (reconstructed)
+        # row.  They swap over for each row.
+        recon = array('B', bytes(rb))
+        prev = array('B', bytes(rb))
+        rview = memoryview(recon)
+        pview = memoryview(prev)
+        # None indicates first line of image.
+        previous = None
         for some in raw:
             a.extend(some)
-            while len(a) >= rb + 1:
-                filter_type = a[0]
-                scanline = a[1:rb+1]
-                del a[:rb+1]
-                recon = self.undo_filter(filter_type, scanline, recon)
-                yield recon
+            # The view must be released before `a` can be resized.
+            with memoryview(a) as view:
+                while len(a) - start >= rb + 1:
+                    filter_type = a[start]
+                    rview[:] = view[start+1:start+rb+1]
+                    start += rb + 1
+                    self.undo_filter(filter_type, recon, previous)
+                    yield recon
+                    recon, prev = prev, recon
+                    rview, pview = pview, rview
+                    previous = prev
+            del a[:start]
+            start = 0
         if len(a) != 0:
             # :file:format We get here with a file format error:
             # when the available bytes (after decompressing) do not
             # pack into exact rows.
             raise FormatError(
               'Wrong size for decompressed IDAT chunk.')
-        assert len(a) == 0
 
     def validate_signature(self):
         """If signature (header) has not been read then read and
@@ -1731,7 +2634,9 @@ class Reader:
         method = '_process_' + as_str(type)
         m = getattr(self, method, None)
         if m:
-            m(data)
+            # Metadata chunks are small; keep a copy rather than a
+            # view of a memory mapped file.
+            m(bytes(data))
 
     def _process_IHDR(self, data):
         # http://www.w3.org/TR/PNG/#11IHDR
@@ -1849,7 +2754,7 @@ class Reader:
         self.x_pixels_per_unit, self.y_pixels_per_unit, unit = struct.unpack(fmt,data)
         self.unit_is_meter = bool(unit)
 
-    def read(self, lenient=False):
+    def read(self, lenient=False, reuse_rows=False):
         """
         Read the PNG file and decode it.  Returns (`width`, `height`,
         `pixels`, `metadata`).
@@ -1860,6 +2765,13 @@ class Reader:
 
         If the optional `lenient` argument evaluates to True,
         checksum failures will raise warnings rather than exceptions.
+
+        If the optional `reuse_rows` argument evaluates to True, the
+        rows of a straightlaced image may be yielded in buffers that
+        are reused for later rows (see :meth:`iterstraight`), saving
+        an allocation and a copy per row.  This suits consumers that
+        process one row at a time; each row must be used (or copied)
+        before the next one is requested.
         """
 
         def iteridat():
@@ -1885,30 +2797,82 @@ class Reader:
             be an iterator that yields the ``IDAT`` chunk data.
             """
 
-            # Currently, with no max_length parameter to decompress,
-            # this routine will do one yield per IDAT chunk: Not very
-            # incremental.
+            expected = self.decompressed_size()
+            window = self.decompress_window
+            total = 0
             d = zlib.decompressobj()
-            # Each IDAT chunk is passed to the decompressor, then any
-            # remaining state is decompressed out.
+            # Each IDAT chunk is passed to the decompressor in slices
+            # of at most a window, and each slice is drained a window
+            # of output at a time, then any remaining state is
+            # decompressed out.  Slicing a memoryview copies nothing,
+            # and `unconsumed_tail` is never more than one slice, so
+            # a large chunk (or a mapped file) is not copied over and
+            # over.
             for data in idat:
-                # :todo: add a max_length argument here to limit output
-                # size.
-                yield array('B', d.decompress(data))
-            yield array('B', d.flush())
+                data = memoryview(data)
+                for i in range(0, len(data), window):
+                    tail = data[i:i+window]
+                    while tail:
+                        some = d.decompress(tail, window)
+                        tail = d.unconsumed_tail
+                        total += len(some)
+                        if total > expected:
+                            raise FormatError(
+                              'Decompressed IDAT data exceeds %d bytes.'
+                              % expected)
+                        yield some
+            yield d.flush()
 
         self.preamble(lenient=lenient)
+        if (self.max_decoded is not None and
+            self.decompressed_size() > self.max_decoded):
+            raise Error("image data (%d bytes) exceeds max_decoded (%d)."
+              % (self.decompressed_size(), self.max_decoded))
         raw = iterdecomp(iteridat())
 
         if self.interlace:
-            raw = array('B', itertools.chain(*raw))
-            arraycode = 'BH'[self.bitdepth>8]
-            # Like :meth:`group` but producing an array.array object for
-            # each row.
-            pixels = map(lambda *row: array(arraycode, row),
-                       *[iter(self.deinterlace(raw))]*self.width*self.planes)
+            try:
+                data = array('B')
+                for some in raw:
+                    data.frombytes(some)
+                flat = self.deinterlace(data)
+            except Exception:
+                # As in iterverify below: report a checksum error in
+                # preference to the decoding error it likely caused.
+                if self.trusted:
+                    self.verify_deferred(lenient)
+                raise
+            vpr = self.width * self.planes
+            pixels = (flat[i:i+vpr] for i in range(0, len(flat), vpr))
         else:
-            pixels = self.iterboxed(self.iterstraight(raw))
+            pixels = self.iterboxed(self.iterstraight(raw),
+                                    copy=not reuse_rows)
+        if self.trusted:
+            def iterverify(pixels):
+                try:
+                    for row in pixels:
+                        yield row
+                except GeneratorExit:
+                    # The consumer stopped early (or the iterator was
+                    # garbage collected); check the chunks read so far
+                    # and release the checksum thread.
+                    self.verify_deferred(lenient)
+                    raise
+                except Exception:
+                    # Corrupt data is likely to fail to decode; report
+                    # the checksum error in preference.
+                    self.verify_deferred(lenient)
+                    raise
+                self.verify_deferred(lenient)
+            pixels = iterverify(pixels)
+        return self.width, self.height, pixels, self._metadata()
+
+    def _metadata(self):
+        """The metadata dictionary returned by :meth:`read` (and
+        :func:`probe`).  The chunks before ``IDAT`` must have been
+        processed.
+        """
+
         meta = dict()
         for attr in 'greyscale alpha planes bitdepth interlace'.split():
             meta[attr] = getattr(self, attr)
@@ -1919,7 +2883,7 @@ class Reader:
                 meta[attr] = a
         if self.plte:
             meta['palette'] = self.palette()
-        return self.width, self.height, pixels, meta
+        return meta
 
 
     def read_flat(self):
@@ -2002,12 +2966,59 @@ class Reader:
         """
 
         self.preamble()
+        return self._direct(*self.read())
+
+    def read_region(self, x, y, width, height, lenient=False):
+        """Read and decode a rectangular region of the image, `width`
+        by `height` pixels with its top left corner at (`x`, `y`).
+        Returns the same 4-tuple as :meth:`asDirect`, with the pixels
+        in the same format, but only those of the region: *width*,
+        *height*, and ``meta['size']`` are those of the region.
+
+        For a straightlaced image, the rows below the region are not
+        decompressed at all; decoding stops at the last row of the
+        region.  Rows above the region still have to be decoded,
+        because each row is filtered relative to the one before.
+        (Interlaced images are necessarily decoded in full.)
+
+        If the optional `lenient` argument evaluates to True,
+        checksum failures will raise warnings rather than exceptions.
+        """
+
+        self.preamble(lenient=lenient)
+        if not (0 <= x and 0 <= y and width > 0 and height > 0 and
+                x + width <= self.width and y + height <= self.height):
+            raise ValueError(
+              "region (%d, %d, %d, %d) is not within the %dx%d image."
+              % (x, y, width, height, self.width, self.height))
+
+        # Each row is sliced (so copied) below, so need not be copied
+        # when it is decoded.
+        _,_,pixels,meta = self.read(lenient=lenient, reuse_rows=True)
+        start = x * self.planes
+        stop = (x + width) * self.planes
+        def iterregion(pixels):
+            # Stops pulling rows through the decoder after the region.
+            for row in itertools.islice(pixels, y, y + height):
+                yield row[start:stop]
+            # :meth:`read` checks deferred checksums only when all its
+            # rows are consumed, which they are not here; check those
+            # of the chunks read for the region.
+            if self.trusted:
+                self.verify_deferred(lenient)
+        pixels = iterregion(pixels)
+        meta['size'] = (width, height)
+        return self._direct(width, height, pixels, meta)
+
+    def _direct(self, x, y, pixels, meta):
+        """Helper used by :meth:`asDirect` and :meth:`read_region`.
+        Converts `pixels`, as returned by :meth:`read`, to the direct
+        representation.
+        """
 
         # Simple case, no conversion necessary.
         if not self.colormap and not self.trns and not self.sbit:
-            return self.read()
-
-        x,y,pixels,meta = self.read()
+            return x,y,pixels,meta
 
         if self.colormap:
             meta['colormap'] = False
@@ -2015,38 +3026,80 @@ class Reader:
             meta['bitdepth'] = 8
             meta['planes'] = 3 + bool(self.trns)
             plte = self.palette()
+            planes = meta['planes']
+            # Look up each channel of a whole row at once: in the
+            # palette as an array with NumPy, otherwise with a
+            # translation table per channel.
+            if numpy is not None:
+                nplte = numpy.array(plte, dtype=numpy.uint8)
+            else:
+                tables = [bytes(bytearray(entry[i] for entry in plte))
+                          .ljust(256, b'\0') for i in range(planes)]
             def iterpal(pixels):
                 for row in pixels:
-                    row = [plte[x] for x in row]
-                    yield array('B', itertools.chain(*row))
+                    row = bytes(row)
+                    if row and max(row) >= len(plte):
+                        raise FormatError(
+                          "Pixel index %d is outside the palette."
+                          % max(row))
+                    if numpy is not None:
+                        row = nplte[numpy.frombuffer(row, numpy.uint8)]
+                        yield array('B', row.tobytes())
+                    else:
+                        yield array('B', _interleave_bytes(
+                          [row.translate(table) for table in tables]))
             pixels = iterpal(pixels)
         elif self.trns:
-            # It would be nice if there was some reasonable way
-            # of doing this without generating a whole load of
-            # intermediate tuples.  But tuples does seem like the
-            # easiest way, with no other way clearly much simpler or
-            # much faster.  (Actually, the L to LA conversion could
-            # perhaps go faster (all those 1-tuples!), but I still
-            # wonder whether the code proliferation is worth it)
             it = self.transparent
             maxval = 2**meta['bitdepth']-1
             planes = meta['planes']
             meta['alpha'] = True
             meta['planes'] += 1
             typecode = 'BH'[meta['bitdepth']>8]
-            def itertrns(pixels):
-                for row in pixels:
-                    # For each row we group it into pixels, then form a
-                    # characterisation vector that says whether each
-                    # pixel is opaque or not.  Then we convert
-                    # True/False to 0/maxval (by multiplication),
-                    # and add it as the extra channel.
-                    row = group(row, planes)
-                    opa = map(it.__ne__, row)
-                    opa = map(maxval.__mul__, opa)
-                    opa = list(zip(opa)) # convert to 1-tuples
-                    yield array(typecode,
-                      itertools.chain(*map(operator.add, row, opa)))
+            if numpy is not None:
+                def itertrns(pixels):
+                    for row in pixels:
+                        row = numpy.asarray(row).reshape(-1, planes)
+                        out = numpy.empty((len(row), planes+1), typecode)
+                        out[:,:planes] = row
+                        out[:,planes] = (row != it).any(axis=1) * maxval
+                        yield array(typecode, out.tobytes())
+            elif typecode == 'B':
+                # Per channel tables giving 0xff where the sample
+                # matches the transparent colour.  The bitwise AND of
+                # the channels (on long integers) is then 0xff for
+                # transparent pixels; `opacity` turns that into alpha.
+                tables = [bytes(bytearray(0xff * (v == t)
+                                          for v in range(256)))
+                          for t in it]
+                opacity = bytes(bytearray([maxval]*255 + [0]))
+                def itertrns(pixels):
+                    for row in pixels:
+                        row = bytes(row)
+                        channels = [row[i::planes] for i in range(planes)]
+                        mask = -1
+                        for channel, table in zip(channels, tables):
+                            mask &= int.from_bytes(
+                              channel.translate(table), 'big')
+                        n = len(channels[0])
+                        alpha = mask.to_bytes(n, 'big').translate(opacity)
+                        yield array('B',
+                                    _interleave_bytes(channels + [alpha]))
+            else:
+                # 16-bit samples: group the row into pixel tuples.
+                def itertrns(pixels):
+                    for row in pixels:
+                        # For each row we group it into pixels, then form a
+                        # characterisation vector that says whether each
+                        # pixel is opaque or not.  Then we convert
+                        # True/False to 0/maxval (by multiplication),
+                        # and add it as the extra channel.
+                        row = group(row, planes)
+                        opa = map(it.__ne__, row)
+                        opa = map(maxval.__mul__, opa)
+                        opa = list(zip(opa)) # convert to 1-tuples
+                        yield array(typecode,
+                          itertools.chain(*map(operator.add, row, opa)))
             pixels = itertrns(pixels)
         targetbitdepth = None
         if self.sbit:
@@ -2079,9 +3132,16 @@ class Reader:
         del info['bitdepth']
         info['maxval'] = float(maxval)
         factor = float(maxval)/float(sourcemaxval)
+        # Each possible value is converted once, into a lookup table.
+        table = [factor * p for p in range(sourcemaxval+1)]
+        if numpy is not None:
+            ntable = numpy.array(table)
         def iterfloat():
             for row in pixels:
-                yield [factor * p for p in row]
+                if numpy is not None:
+                    yield ntable[numpy.asarray(row)].tolist()
+                else:
+                    yield list(map(table.__getitem__, row))
         return x,y,iterfloat(),info
 
     def _as_rescale(self, get, targetbitdepth):
@@ -2092,9 +3152,26 @@ class Reader:
         targetmaxval = 2**targetbitdepth - 1
         factor = float(targetmaxval) / float(maxval)
         meta['bitdepth'] = targetbitdepth
+        # Each possible value is rescaled once, into a lookup table,
+        # which is then applied a row at a time: with
+        # :meth:`bytes.translate` for byte rows, otherwise by NumPy
+        # indexing or by mapping ``table.__getitem__`` over the row.
+        table = [int(round(x*factor)) for x in range(maxval+1)]
+        typecode = 'BH'[targetbitdepth > 8]
+        translate = None
+        if typecode == 'B' and maxval <= 255:
+            translate = bytes(bytearray(table + [0]*(255-maxval)))
+        if numpy is not None:
+            ntable = numpy.array(table, dtype=typecode)
         def iterscale():
             for row in pixels:
-                yield [int(round(x*factor)) for x in row]
+                if translate and isarray(row) and row.typecode == 'B':
+                    yield array('B', row.tobytes().translate(translate))
+                elif numpy is not None:
+                    yield array(typecode,
+                                ntable[numpy.asarray(row)].tobytes())
+                else:
+                    yield array(typecode, map(table.__getitem__, row))
         if maxval == targetmaxval:
             return width, height, pixels, meta
         else:
@@ -2208,6 +3285,103 @@ class Reader:
         meta['greyscale'] = False
         return width,height,convert(),meta
 
+def probe(path):
+    """Return the metadata of the PNG file `path`, without reading
+    any of its image data.  Only the chunks before the first ``IDAT``
+    chunk are read: ``IHDR``, and ``PLTE``, ``tRNS``, ``gAMA`` and the
+    other chunks that :meth:`Reader.process_chunk` understands.  The
+    result is a dictionary like the metadata returned by
+    :meth:`Reader.read`, with ``palette`` converted from ``PLTE`` and
+    ``tRNS`` for colour mapped images.
+    """
+
+    r = Reader(filename=path)
+    try:
+        r.preamble()
+        return r._metadata()
+    finally:
+        r.file.close()
+
+def _scan_file(path):
+    """Probe one file for :func:`scan`, returning its record."""
+
+    record = dict(path=path)
+    try:
+        record['file_size'] = os.path.getsize(path)
+        r = Reader(filename=path)
+        try:
+            r.preamble()
+        finally:
+            r.file.close()
+    except Exception as e:
+        # Malformed files can fail in many ways, not all of them as
+        # Error; none of them should stop the scan.
+        if isinstance(e, (EnvironmentError, Error)):
+            record['error'] = str(e)
+        else:
+            record['error'] = '%s: %s' % (e.__class__.__name__, e)
+        return record
+    record.update(width=r.width, height=r.height,
+                  color_type=r.color_type, bitdepth=r.bitdepth,
+                  interlace=r.interlace,
+                  palette_size=len(r.plte)//3 if r.plte else 0)
+    return record
+
+# The fields of the records yielded by :func:`scan`, in table order.
+scan_fields = ['path', 'width', 'height', 'color_type', 'bitdepth',
+               'interlace', 'palette_size', 'file_size', 'error']
+
+def _walk_pngs(paths):
+    """Yield `paths`, replacing each directory with the PNG files
+    (named ``*.png``, in any case) in the tree below it, in sorted
+    order.
+    """
+
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.lower().endswith('.png'):
+                    yield os.path.join(dirpath, name)
+
+def scan(paths, workers=None):
+    """Read the header of many PNG files at once.  `paths` is a file
+    or directory name, or a list of them; directories are searched
+    recursively for ``*.png`` files.  The files are probed (see
+    :func:`probe`) on a pool of `workers` threads (by default, a few
+    more than the number of CPUs, as the work is mostly waiting for
+    I/O).
+
+    Yields a dictionary for each file, in order, with the keys listed
+    in `scan_fields`: ``path``, ``width``, ``height``, ``color_type``,
+    ``bitdepth``, ``interlace``, ``palette_size`` (0 when there is no
+    ``PLTE`` chunk) and ``file_size``.  A file that cannot be read
+    does not stop the scan; its record has only ``path``, perhaps
+    ``file_size``, and ``error``, a message.
+    """
+
+    import concurrent.futures
+
+    if isinstance(paths, str):
+        paths = [paths]
+    if not workers:
+        workers = min(32, (os.cpu_count() or 1) + 4)
+    # Bound the number of files in flight, so that scanning a huge
+    # tree does not queue a future for every file before the first
+    # result is yielded.
+    limit = 4 * workers
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for path in _walk_pngs(paths):
+            pending.append(executor.submit(_scan_file, path))
+            if len(pending) >= limit:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
 def check_bitdepth_colortype(bitdepth, colortype):
     """Check that `bitdepth` and `colortype` are both valid,
     and specified in a valid combination. Returns if valid,
@@ -2334,6 +3508,107 @@ except NameError:
                 result[i::4] = row[i::3]
         convert_rgb_to_rgba = staticmethod(convert_rgb_to_rgba)
 
+    if numpy is not None:
+        class numpyfilters(pngfilters):
+            """The ``undo_filter_*`` functions of :class:`pngfilters`,
+            using NumPy.  The results are identical.
+
+            Only "up" and "sub" are vectorized: "up" is a single vector
+            addition and "sub" a running sum down each byte column of
+            the scanline (the stride between columns being the filter
+            unit), 10 to 30 times faster than pure Python.
+
+            "average" and "paeth" are not vectorized, and are only
+            1.2 to 2 times faster.  Each reconstructed byte
+            depends non-linearly (through the halving, or the choice
+            of predictor) on the one reconstructed a pixel to its
+            left, so unlike "sub" there is no running sum to hand to
+            NumPy; processing the bytes of a pixel together (as lanes
+            of one integer) measured no faster for 8-bit images.
+            What is done is to compute everything derived from the
+            previous scanline up front, leaving a tight loop over
+            plain integers for each byte column.
+            """
+
+            def undo_filter_sub(filter_unit, scanline, previous, result):
+                """Undo sub filter."""
+
+                r = numpy.frombuffer(result, dtype=numpy.uint8)
+                # One row per pixel, one column per byte of the pixel;
+                # the scanline is always a whole number of pixels.
+                r = r.reshape(-1, filter_unit)
+                # Summing in uint8 does the ``& 0xff`` for us.
+                numpy.cumsum(r, axis=0, dtype=numpy.uint8, out=r)
+            undo_filter_sub = staticmethod(undo_filter_sub)
+
+            def undo_filter_up(filter_unit, scanline, previous, result):
+                """Undo up filter."""
+
+                numpy.add(numpy.frombuffer(scanline, dtype=numpy.uint8),
+                          numpy.frombuffer(previous, dtype=numpy.uint8),
+                          out=numpy.frombuffer(result, dtype=numpy.uint8))
+            undo_filter_up = staticmethod(undo_filter_up)
+
+            def undo_filter_average(filter_unit, scanline, previous, result):
+                """Undo average filter, a loop per byte column (see the
+                class docstring)."""
+
+                x = numpy.frombuffer(scanline, dtype=numpy.uint8)
+                b = numpy.frombuffer(previous, dtype=numpy.uint8)
+                r = numpy.frombuffer(result, dtype=numpy.uint8)
+                for i in range(filter_unit):
+                    a = 0
+                    column = []
+                    append = column.append
+                    for x_i, b_i in zip(x[i::filter_unit].tolist(),
+                                        b[i::filter_unit].tolist()):
+                        a = (x_i + ((a + b_i) >> 1)) & 0xff
+                        append(a)
+                    r[i::filter_unit] = column
+            undo_filter_average = staticmethod(undo_filter_average)
+
+            def undo_filter_paeth(filter_unit, scanline, previous, result):
+                """Undo Paeth filter, a loop per byte column (see the
+                class docstring)."""
+
+                x = numpy.frombuffer(scanline, dtype=numpy.uint8)
+                b = numpy.frombuffer(previous, dtype=numpy.uint8)
+                r = numpy.frombuffer(result, dtype=numpy.uint8)
+                b = b.astype(numpy.intp)
+                # c is the byte above and to the left; 0 for the first
+                # pixel.
+                c = numpy.zeros_like(b)
+                c[filter_unit:] = b[:-filter_unit]
+                # With p = a + b - c, the predictor distances are
+                # pa = |b - c|, pb = |a - c|, and pc = |a + (b - 2c)|.
+                # Only pa is independent of a.
+                pa = numpy.abs(b - c)
+                d = b - 2*c
+                for i in range(filter_unit):
+                    a = 0
+                    column = []
+                    append = column.append
+                    for x_i, pa_i, b_i, c_i, d_i in zip(
+                            x[i::filter_unit].tolist(),
+                            pa[i::filter_unit].tolist(),
+                            b[i::filter_unit].tolist(),
+                            c[i::filter_unit].tolist(),
+                            d[i::filter_unit].tolist()):
+                        pb = abs(a - c_i)
+                        pc = abs(a + d_i)
+                        if pa_i <= pb and pa_i <= pc:
+                            pr = a
+                        elif pb <= pc:
+                            pr = b_i
+                        else:
+                            pr = c_i
+                        a = (x_i + pr) & 0xff
+                        append(a)
+                    r[i::filter_unit] = column
+            undo_filter_paeth = staticmethod(undo_filter_paeth)
+
+        pngfilters = numpyfilters
+
 
 # === Command Line Support ===
 
@@ -2490,14 +3765,14 @@ def write_pnm(file, width, height, pixels, meta):
     file.write(header.encode('ascii'))
     # Values per row
     vpr = planes * width
-    # struct format
-    fmt = '>%d' % vpr
     if maxval > 0xff:
-        fmt = fmt + 'H'
+        for row in pixels:
+            file.write(_to_be16(row))
     else:
-        fmt = fmt + 'B'
-    for row in pixels:
-        file.write(struct.pack(fmt, *row))
+        # struct format
+        fmt = '>%dB' % vpr
+        for row in pixels:
+            file.write(struct.pack(fmt, *row))
     file.flush()
 
 def color_triple(color):
@@ -2540,51 +3815,62 @@ def _add_common_options(parser):
                       help="zlib compression level (0-9)")
     return parser
 
-def _main(argv):
+def _scan_main(argv):
     """
-    Run the PNG encoder with options from the command line.
+    Run the ``scan`` subcommand: write a table of the headers of the
+    PNG files named on the command line (or found in the directories
+    named) to stdout, and the throughput to stderr.
     """
 
-    # Parse command line arguments
+    import csv
+    import json
+    import time
     from optparse import OptionParser
-    version = '%prog ' + __version__
-    parser = OptionParser(version=version)
-    parser.set_usage("%prog [options] [imagefile]")
-    parser.add_option('-r', '--read-png', default=False,
-                      action='store_true',
-                      help='Read PNG, write PNM')
-    parser.add_option("-a", "--alpha",
-                      action="store", type="string", metavar="pgmfile",
-                      help="alpha channel transparency (RGBA)")
-    _add_common_options(parser)
-
+    parser = OptionParser(version='%prog ' + __version__)
+    parser.set_usage("%prog scan [options] path ...")
+    parser.add_option("-f", "--format", default="json",
+                      choices=["json", "csv"],
+                      help="output format: json (default) or csv")
+    parser.add_option("-j", "--jobs", default=None, type="int",
+                      metavar="N", help="number of threads")
     (options, args) = parser.parse_args(args=argv[1:])
-
-    # Convert options
-    if options.transparent is not None:
-        options.transparent = color_triple(options.transparent)
-    if options.background is not None:
-        options.background = color_triple(options.background)
-
-    # Prepare input and output files
-    if len(args) == 0:
-        infilename = '-'
-        infile = sys.stdin
-    elif len(args) == 1:
-        infilename = args[0]
-        infile = open(infilename, 'rb')
+    if not args:
+        parser.error("no files or directories to scan")
+
+    out = sys.stdout
+    start = time.time()
+    n = 0
+    if options.format == 'csv':
+        writer = csv.DictWriter(out, scan_fields)
+        writer.writeheader()
     else:
-        parser.error("more than one input file")
-    outfile = sys.stdout
-    if sys.platform == "win32":
-        import msvcrt, os
-        msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+        out.write('[')
+    for record in scan(args, workers=options.jobs):
+        if options.format == 'csv':
+            writer.writerow(record)
+        else:
+            out.write((',\n ' if n else '\n ') +
+                      json.dumps(record, sort_keys=True))
+        n += 1
+    if options.format != 'csv':
+        out.write(']\n')
+    out.flush()
+    seconds = time.time() - start
+    print("scanned %d files in %.2f s (%.0f files/s)" %
+          (n, seconds, n / seconds if seconds else 0.0), file=sys.stderr)
+
+def _convert(infile, outfile, options, infilename='-'):
+    """
+    Convert one image from `infile` to `outfile`: PNG to PNM when
+    `options.read_png` is set, otherwise PNM to PNG.  `options` are
+    the parsed command line options of :func:`_main`.
+    """
 
     if options.read_png:
         # Encode PNG to PPM
         png = Reader(file=infile)
         width,height,pixels,meta = png.asDirect()
-        write_pnm(outfile, width, height, pixels, meta) 
+        write_pnm(outfile, width, height, pixels, meta)
     else:
         # Encode PNM to PNG
         format, width, height, depth, maxval = \
@@ -2631,8 +3917,187 @@ def _main(argv):
             writer.convert_pnm(infile, outfile)
 
 
+def _convert_file(inpath, outpath, options):
+    """
+    Convert the file `inpath` to `outpath` for :func:`_batch`,
+    returning a record of the result rather than raising an
+    exception.  An incomplete output file is removed.
+    """
+
+    import time
+    start = time.time()
+    record = dict(input=inpath, output=outpath)
+    try:
+        with open(inpath, 'rb') as infile:
+            with open(outpath, 'wb') as outfile:
+                _convert(infile, outfile, options, inpath)
+    except Exception as e:
+        if isinstance(e, Error):
+            # Already names the error class.
+            record['error'] = str(e)
+        else:
+            record['error'] = '%s: %s' % (e.__class__.__name__, e)
+        if os.path.exists(outpath):
+            os.remove(outpath)
+    record['seconds'] = time.time() - start
+    return record
+
+def _batch_jobs(paths, options):
+    """Return a list of (*input*, *output*) pairs of file names, one
+    for each conversion in a batch.  Directories in `paths` are
+    searched for files of the input format; their tree structure is
+    reproduced below `options.output_dir`.  Files named directly are
+    converted into `options.output_dir` itself.  Raises :class:`Error`
+    if two inputs would be converted to the same output file (such as
+    ``a/x.ppm`` and ``b/x.ppm``), before anything is converted.
+    """
+
+    if options.read_png:
+        extensions, outext = ('.png',), '.pnm'
+    else:
+        extensions, outext = ('.pnm', '.pbm', '.pgm', '.ppm', '.pam'), '.png'
+    def iterjobs():
+        for path in paths:
+            if not os.path.isdir(path):
+                name = os.path.splitext(os.path.basename(path))[0]
+                yield path, os.path.join(options.output_dir, name + outext)
+                continue
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                outdir = os.path.join(options.output_dir,
+                                      os.path.relpath(dirpath, path))
+                for filename in sorted(filenames):
+                    name, ext = os.path.splitext(filename)
+                    if ext.lower() in extensions:
+                        yield (os.path.join(dirpath, filename),
+                               os.path.normpath(
+                                 os.path.join(outdir, name + outext)))
+    jobs = []
+    # Input file for each output file, compared as the file system
+    # would (case insensitively, on some).
+    seen = {}
+    for inpath, outpath in iterjobs():
+        key = os.path.normcase(os.path.abspath(outpath))
+        if key in seen:
+            raise Error("%s and %s would both be converted to %s."
+                        % (seen[key], inpath, outpath))
+        seen[key] = inpath
+        jobs.append((inpath, outpath))
+    return jobs
+
+def _batch(paths, options):
+    """
+    Convert many files, `paths` (files or directories), into
+    `options.output_dir` using a pool of `options.jobs` processes.
+    The output file names are all worked out (and checked not to
+    clash, see :func:`_batch_jobs`) first.
+    Only a few conversions per process are queued at a time, so
+    memory use stays bounded however many files there are.  A line
+    is printed for every file, followed by a summary; failed files
+    are reported and the rest of the batch carries on.  Returns the
+    number of failures.
+    """
+
+    import concurrent.futures
+    import time
+
+    jobs = options.jobs or os.cpu_count() or 1
+    start = time.time()
+    results = []
+    def report(record):
+        results.append(record)
+        if 'error' in record:
+            print("FAILED %s: %s" % (record['input'], record['error']))
+        else:
+            print("ok %s -> %s (%.2f s)" %
+                  (record['input'], record['output'], record['seconds']))
+    limit = 2 * jobs
+    pending = collections.deque()
+    batch = _batch_jobs(paths, options)
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        for inpath, outpath in batch:
+            outdir = os.path.dirname(outpath)
+            if outdir and not os.path.isdir(outdir):
+                os.makedirs(outdir)
+            pending.append(
+              executor.submit(_convert_file, inpath, outpath, options))
+            if len(pending) >= limit:
+                report(pending.popleft().result())
+        while pending:
+            report(pending.popleft().result())
+    failed = sum('error' in record for record in results)
+    print("converted %d of %d files in %.2f s using %d processes, "
+          "%d failed" % (len(results) - failed, len(results),
+                         time.time() - start, jobs, failed))
+    return failed
+
+def _main(argv):
+    """
+    Run the PNG encoder with options from the command line.
+    """
+
+    if argv[1:2] == ['scan']:
+        return _scan_main(argv[:1] + argv[2:])
+
+    # Parse command line arguments
+    from optparse import OptionParser
+    version = '%prog ' + __version__
+    parser = OptionParser(version=version)
+    parser.set_usage("%prog [options] [imagefile]\n"
+                     "       %prog -o dir [options] path ...\n"
+                     "       %prog scan [options] path ...")
+    parser.add_option('-r', '--read-png', default=False,
+                      action='store_true',
+                      help='Read PNG, write PNM')
+    parser.add_option("-a", "--alpha",
+                      action="store", type="string", metavar="pgmfile",
+                      help="alpha channel transparency (RGBA)")
+    parser.add_option("-o", "--output-dir",
+                      action="store", type="string", metavar="dir",
+                      help="batch mode: convert every input file (or "
+                           "file in an input directory) into dir")
+    parser.add_option("-j", "--jobs",
+                      action="store", type="int", metavar="N",
+                      help="batch mode: number of processes "
+                           "(default: number of CPUs)")
+    _add_common_options(parser)
+
+    (options, args) = parser.parse_args(args=argv[1:])
+
+    # Convert options
+    if options.transparent is not None:
+        options.transparent = color_triple(options.transparent)
+    if options.background is not None:
+        options.background = color_triple(options.background)
+
+    if options.output_dir is not None:
+        if options.alpha:
+            parser.error("--alpha cannot be used with --output-dir")
+        if not args:
+            parser.error("no input files for --output-dir")
+        return _batch(args, options)
+
+    # Prepare input and output files
+    if len(args) == 0:
+        infilename = '-'
+        infile = getattr(sys.stdin, 'buffer', sys.stdin)
+    elif len(args) == 1:
+        infilename = args[0]
+        infile = open(infilename, 'rb')
+    else:
+        parser.error("more than one input file")
+    outfile = getattr(sys.stdout, 'buffer', sys.stdout)
+    if sys.platform == "win32":
+        import msvcrt
+        msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+
+    _convert(infile, outfile, options, infilename)
+
+
 if __name__ == '__main__':
     try:
-        _main(sys.argv)
+        if _main(sys.argv):
+            sys.exit(1)
     except Error as e:
         print(e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for ``png.py``.
+
+Run ``python pngbench.py`` to run every benchmark, or name the ones
+wanted on the command line (``python pngbench.py decode``).  Type
+``python pngbench.py --help`` for the options.
+
+The ``--no-numpy`` option hides NumPy from ``png.py`` so that the
+pure Python code paths can be compared with the NumPy ones.
+"""
+
+from __future__ import print_function
+
+import io
+import random
+import struct
+import sys
+import time
+import zlib
+
+from array import array
+from functools import reduce
+
+
+def _import_png(use_numpy):
+    """Import and return the `png` module, optionally hiding NumPy
+    from it.
+    """
+
+    if not use_numpy:
+        # An entry of None makes ``import numpy`` raise ImportError.
+        sys.modules['numpy'] = None
+    import png
+    return png
+
+
+def _timeit(f, repeat):
+    """Call `f` `repeat` times and return the best time, in seconds."""
+
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        f()
+        t = time.time() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def _report(name, seconds, nbytes):
+    """Print one line of benchmark results."""
+
+    print("%-32s %8.3f s %8.2f MB/s" %
+          (name, seconds, nbytes / seconds / 1e6 if seconds else 0.0))
+
+
+def _sprite_row(width, planes):
+    """A row of pixel art: runs of a few colours, as a byte array."""
+
+    colours = [[random.randrange(256) for _ in range(planes)]
+               for _ in range(8)]
+    row = array('B')
+    while len(row) < width*planes:
+        row.extend(random.choice(colours) * random.randint(1, 12))
+    return row[:width*planes]
+
+
+def _filtered_png(png, width, height, planes, filter_type):
+    """Return the bytes of an 8-bit PNG image where every scanline
+    uses `filter_type`.
+    """
+
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[planes]
+    raw = array('B')
+    prev = None
+    for _ in range(height):
+        line = _sprite_row(width, planes)
+        raw.extend(png.filter_scanline(filter_type, line, planes, prev))
+        prev = line
+    out = io.BytesIO()
+    png.write_chunks(out, [
+        (b'IHDR', struct.pack("!2I5B", width, height, 8, color_type,
+                              0, 0, 0)),
+        (b'IDAT', zlib.compress(raw.tobytes())),
+        (b'IEND', b'')])
+    return out.getvalue()
+
+
+def bench_decode(png, options):
+    """Decode images that use each of the 5 filter types."""
+
+    names = ['none', 'sub', 'up', 'average', 'paeth']
+    for filter_type, name in enumerate(names):
+        data = _filtered_png(png, options.width, options.height, 4,
+                             filter_type)
+        def decode():
+            for _ in png.Reader(bytes=data).read()[2]:
+                pass
+        _report("decode RGBA8 %s" % name,
+                _timeit(decode, options.repeat),
+                options.width * options.height * 4)
+
+
+def _sprite_rows(width, height, planes):
+    """Rows of pixel art, with some vertical coherence."""
+
+    rows = []
+    for y in range(height):
+        if rows and random.random() < 0.7:
+            rows.append(array('B', rows[-1]))
+        else:
+            rows.append(_sprite_row(width, planes))
+    return rows
+
+
+def bench_encode(png, options):
+    """Encode an RGBA8 image with each filter type."""
+
+    rows = _sprite_rows(options.width, options.height, 4)
+    for filter_type in [0, 1, 2, 3, 4, 'adaptive']:
+        writer = png.Writer(options.width, options.height, alpha=True,
+                            filter_type=filter_type)
+        out = io.BytesIO()
+        def encode():
+            out.seek(0)
+            out.truncate()
+            writer.write(out, rows)
+        seconds = _timeit(encode, options.repeat)
+        _report("encode RGBA8 filter %s" % filter_type, seconds,
+                options.width * options.height * 4)
+        print("%32s %8d bytes" % ('', len(out.getvalue())))
+
+
+def bench_parallel(png, options):
+    """Encode an RGBA8 image compressing on 1, 2, 4, and all CPUs."""
+
+    rows = _sprite_rows(options.width, options.height, 4)
+    for workers in [1, 2, 4, 0]:
+        writer = png.Writer(options.width, options.height, alpha=True,
+                            compress_workers=workers)
+        out = io.BytesIO()
+        def encode():
+            out.seek(0)
+            out.truncate()
+            writer.write(out, rows)
+        seconds = _timeit(encode, options.repeat)
+        _report("encode RGBA8 %d threads" % writer.compress_workers,
+                seconds, options.width * options.height * 4)
+        print("%32s %8d bytes" % ('', len(out.getvalue())))
+
+
+def bench_interlace(png, options):
+    """Encode and decode an RGBA8 image, plain and interlaced."""
+
+    rows = _sprite_rows(options.width, options.height, 4)
+    for interlace in [False, True]:
+        writer = png.Writer(options.width, options.height, alpha=True,
+                            interlace=interlace)
+        out = io.BytesIO()
+        def encode():
+            out.seek(0)
+            out.truncate()
+            writer.write(out, rows)
+        name = ['plain', 'interlaced'][interlace]
+        _report("encode RGBA8 %s" % name, _timeit(encode, options.repeat),
+                options.width * options.height * 4)
+        data = out.getvalue()
+        def decode():
+            for _ in png.Reader(bytes=data).read()[2]:
+                pass
+        _report("decode RGBA8 %s" % name, _timeit(decode, options.repeat),
+                options.width * options.height * 4)
+
+
+def _legacy_unpack(raw, bitdepth, width):
+    """Unpack samples the way ``png.py`` used to, a byte at a time."""
+
+    spb = 8//bitdepth
+    out = array('B')
+    mask = 2**bitdepth - 1
+    shifts = [bitdepth * i for i in reversed(list(range(spb)))]
+    for o in raw:
+        out.extend([mask&(o>>i) for i in shifts])
+    return out[:width]
+
+
+def _legacy_pack(values, bitdepth):
+    """Pack samples the way ``png.py`` used to, a byte at a time."""
+
+    spb = 8//bitdepth
+    a = array('B', values)
+    a.extend([0] * (-len(a) % spb))
+    return array('B', [reduce(lambda x, y: (x << bitdepth) + y, e)
+                       for e in zip(*[iter(a)]*spb)])
+
+
+def bench_subbyte(png, options):
+    """Pack and unpack rows of 1, 2, and 4 bit samples, comparing
+    the table-driven routines with the old byte at a time code.
+    """
+
+    width = options.width
+    for bitdepth in [1, 2, 4]:
+        rows = [array('B', [random.randrange(2**bitdepth)
+                            for _ in range(width)])
+                for _ in range(options.height)]
+        packed = [png.pack_samples(row, bitdepth) for row in rows]
+        nbytes = width * options.height
+        for name, pack, unpack in [
+          ('old', _legacy_pack, _legacy_unpack),
+          ('new', png.pack_samples, png.unpack_samples)]:
+            _report("pack %d-bit %s" % (bitdepth, name),
+                    _timeit(lambda: [pack(row, bitdepth) for row in rows],
+                            options.repeat), nbytes)
+            _report("unpack %d-bit %s" % (bitdepth, name),
+                    _timeit(lambda: [unpack(row, bitdepth, width)
+                                     for row in packed],
+                            options.repeat), nbytes)
+
+
+def bench_deep(png, options):
+    """Encode and decode an RGBA image at 8 and 16 bits per sample."""
+
+    width, height = options.width, options.height
+    for bitdepth in [8, 16]:
+        scale = 2**bitdepth // 256
+        rows = [array('BH'[bitdepth > 8], [v * scale for v in row])
+                for row in _sprite_rows(width, height, 4)]
+        writer = png.Writer(width, height, alpha=True, bitdepth=bitdepth)
+        out = io.BytesIO()
+        def encode():
+            out.seek(0)
+            out.truncate()
+            writer.write(out, rows)
+        _report("encode RGBA%d" % bitdepth,
+                _timeit(encode, options.repeat), width * height * 4)
+        data = out.getvalue()
+        def decode():
+            for _ in png.Reader(bytes=data).read()[2]:
+                pass
+        _report("decode RGBA%d" % bitdepth,
+                _timeit(decode, options.repeat), width * height * 4)
+
+
+def bench_optimize(png, options):
+    """Encode an RGBA8 image with the fast profile, then with every
+    combination tried by Writer.write_optimized.
+    """
+
+    rows = _sprite_rows(options.width, options.height, 4)
+    writer = png.Writer(options.width, options.height, alpha=True,
+                        **png.profiles['fast'])
+    out = io.BytesIO()
+    def encode():
+        out.seek(0)
+        out.truncate()
+        writer.write(out, rows)
+    _report("encode RGBA8 fast profile", _timeit(encode, options.repeat),
+            options.width * options.height * 4)
+    print("%32s %8d bytes" % ('', len(out.getvalue())))
+    writer = png.Writer(options.width, options.height, alpha=True)
+    for c in writer.write_optimized(io.BytesIO(), rows):
+        _report("level %(compression)d %(strategy)s filter %(filter_type)s"
+                % c, c['seconds'], options.width * options.height * 4)
+        print("%32s %8d bytes" % ('', c['size']))
+
+
+benchmarks = [
+    ('decode', bench_decode),
+    ('encode', bench_encode),
+    ('parallel', bench_parallel),
+    ('interlace', bench_interlace),
+    ('subbyte', bench_subbyte),
+    ('deep', bench_deep),
+    ('optimize', bench_optimize),
+]
+
+
+def _main(argv):
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.set_usage("%prog [options] [benchmark ...]")
+    parser.add_option("--no-numpy", dest="numpy", default=True,
+                      action="store_false",
+                      help="hide NumPy from png.py")
+    parser.add_option("-W", "--width", default=512, type="int",
+                      help="width of the test images")
+    parser.add_option("-H", "--height", default=512, type="int",
+                      help="height of the test images")
+    parser.add_option("-n", "--repeat", default=3, type="int",
+                      help="runs per benchmark (the best is reported)")
+    (options, args) = parser.parse_args(args=argv[1:])
+
+    known = dict(benchmarks)
+    for name in args:
+        if name not in known:
+            parser.error("unknown benchmark %s (choose from %s)" %
+                         (name, ', '.join(n for n, _ in benchmarks)))
+    png = _import_png(options.numpy)
+    random.seed(0)
+    print("png.py filters: %s" % png.pngfilters.__name__)
+    for name, bench in benchmarks:
+        if not args or name in args:
+            bench(png, options)
+
+
+if __name__ == '__main__':
+    _main(sys.argv)
@@ -1,15 +1,22 @@
 """The main pixel art window, containing the DrawControl and MainWindow classes"""
-from array import array
 import os
 import wx
 import png
 import tool
 import color as clr
 import command
+import canvas
 
 
 class DrawControl(wx.Control):
     """ The DrawControl class contains the image which we are maniplulating  """
+    #pylint: disable=too-many-instance-attributes
+
+    # the render cache is made of square tiles this many pixels wide,
+    # a multiple of the checkerboard tile so that the pattern lines up
+    TILE = 400
+    # lookup tables for lower_to_bit_depth, by depth
+    _depth_tables = {}
 
     #pylint: disable-msg=too-many-arguments
     def __init__(self, parent, window, image_size=(64, 64), color=(255, 255, 255, 255),
@@ -23,17 +30,23 @@ class DrawControl(wx.Control):
         self.image_size = image_size
         # TODO add the ability to add, remove, show, and hide layers
         self.layers = []
-        layer = wx.Bitmap.ConvertToImage(wx.Bitmap.FromRGBA(
-            image_size[0], image_size[1], 0, 0, 0, 0))
+        layer = canvas.Canvas(image_size[0], image_size[1])
         self.layers.append(layer)
         self.active_layer = layer
         self.color = color
         self.scale = scale = 1
         self.prev = None
+        # tiles of the image scaled and drawn over the checkerboard, by
+        # (column, row), and the (scale, version) they were rendered at;
+        # version counts changes
+        self.version = 0
+        self.tiles = {}
+        self.tiles_key = None
         self.GetParent().SetVirtualSize(
             (image_size[0] * scale, image_size[1] * scale))
         self.GetParent().SetScrollRate(1, 1)
 
+        self.GetParent().Bind(wx.EVT_SIZE, self.on_parent_size)
         self.Bind(wx.EVT_PAINT, self.on_paint)
         self.Bind(wx.EVT_LEFT_DOWN, self.on_click)
         self.Bind(wx.EVT_RIGHT_DOWN, self.on_click)
@@ -42,17 +55,122 @@ class DrawControl(wx.Control):
         # self.SetCursor(wx.Cursor(wx.CURSOR_PENCIL))
 
     def _resize(self):
-        """ Helper function used when when zooming or loading a new image """
+        """ Helper function used when when zooming, loading a new image or
+            resizing the DrawWindow.  Only the DrawWindow's virtual size
+            is that of the whole scaled image, the control itself is never
+            bigger than the DrawWindow (it stays put while the DrawWindow
+            scrolls its contents) """
         image_size = self.image_size
-        wsize = (image_size[0] * self.scale + 2,
-                 image_size[1] * self.scale + 2)
-        self.SetSize(wsize)
-        self.SetMinSize(wsize)
-        self.SetMaxSize(wsize)
-        self.GetParent().SetVirtualSize(wsize)
-        self.GetParent().SetScrollRate(1, 1)
+        extent = (image_size[0] * self.scale, image_size[1] * self.scale)
+        parent = self.GetParent()
+        parent.SetVirtualSize(extent)
+        parent.SetScrollRate(1, 1)
+        (p_w, p_h) = parent.GetClientSize()
+        # 2 for the border, centred when it is smaller than the DrawWindow
+        (width, height) = (min(extent[0] + 2, p_w), min(extent[1] + 2, p_h))
+        self.SetSize((p_w - width) // 2, (p_h - height) // 2, width, height)
         self.Refresh()
 
+    def on_parent_size(self, event):
+        """ Keep filling the DrawWindow as it changes size """
+        self._resize()
+        event.Skip()
+
+    def _origin(self):
+        """ Where the top left of the control is in the scaled image, which
+            depends on how far the DrawWindow is scrolled """
+        return self.GetParent().CalcUnscrolledPosition(0, 0)
+
+    def invalidate(self):
+        """ Forget the render cache, for when the whole image changed """
+        self.version += 1
+
+    def image_changed(self, box):
+        """ Patch the render cache and repaint the damaged area after the
+            pixels in box (x, y, width, height) were modified, box is
+            None when nothing changed """
+        if box is None:
+            return
+        rect = wx.Rect(0, 0, *self.image_size).Intersect(wx.Rect(*box))
+        if rect.IsEmpty():
+            return
+        scale = self.scale
+        damage = wx.Rect(rect.x * scale, rect.y * scale,
+                         rect.width * scale, rect.height * scale)
+        if self.tiles_key == (self.scale, self.version):
+            mem_dc = wx.MemoryDC()
+            for (tile_rect, bitmap) in self._tiles(damage, False):
+                mem_dc.SelectObject(bitmap)
+                self._render_area(mem_dc, tile_rect,
+                                  wx.Rect(tile_rect).Intersect(damage))
+            mem_dc.SelectObject(wx.NullBitmap)
+            self.tiles_key = (self.scale, self.version + 1)
+        self.version += 1
+        origin = self._origin()
+        self.RefreshRect(wx.Rect(damage.x - origin.x, damage.y - origin.y,
+                                 damage.width, damage.height), False)
+
+    def _render_area(self, mem_dc, tile_rect, area):
+        """ Draw area (in scaled image coordinates) of the scaled image over
+            the checkerboard, into the tile at tile_rect selected in mem_dc """
+        scale = self.scale
+        # the image pixels that cover the area
+        pixels = wx.Rect(wx.Point(area.x // scale, area.y // scale),
+                         wx.Point(area.GetRight() // scale,
+                                  area.GetBottom() // scale))
+        (x_pos, y_pos) = (area.x - tile_rect.x, area.y - tile_rect.y)
+        mem_dc.SetClippingRegion(x_pos, y_pos, area.width, area.height)
+        mem_dc.SetPen(wx.TRANSPARENT_PEN)
+        mem_dc.SetBrush(clr.checkerboard())
+        mem_dc.DrawRectangle(x_pos, y_pos, area.width, area.height)
+        scaled = self.active_layer.to_image().GetSubImage(pixels).Scale(
+            pixels.width * scale, pixels.height * scale)
+        mem_dc.DrawBitmap(wx.Bitmap(scaled), pixels.x * scale - tile_rect.x,
+                          pixels.y * scale - tile_rect.y)
+        mem_dc.DestroyClippingRegion()
+
+    def _tiles(self, area, render=True):
+        """ Yields (rect, bitmap) for the tiles of the render cache over
+            area, rendering the missing ones, or skipping them if not
+            render """
+        key = (self.scale, self.version)
+        if self.tiles_key != key:
+            self.tiles = {}
+            self.tiles_key = key
+        tile = self.TILE
+        (width, height) = (self.image_size[0] * self.scale,
+                           self.image_size[1] * self.scale)
+        for row in range(area.y // tile, area.GetBottom() // tile + 1):
+            for column in range(area.x // tile, area.GetRight() // tile + 1):
+                rect = wx.Rect(column * tile, row * tile,
+                               min(tile, width - column * tile),
+                               min(tile, height - row * tile))
+                bitmap = self.tiles.get((column, row))
+                if bitmap is None:
+                    if not render:
+                        continue
+                    bitmap = wx.Bitmap(rect.width, rect.height)
+                    mem_dc = wx.MemoryDC(bitmap)
+                    self._render_area(mem_dc, rect, rect)
+                    mem_dc.SelectObject(wx.NullBitmap)
+                    self.tiles[(column, row)] = bitmap
+                yield (rect, bitmap)
+
+    def _visible(self):
+        """ The part of the scaled image the control shows """
+        origin = self._origin()
+        return wx.Rect(origin.x, origin.y, *self.GetClientSize())
+
+    def _prune_tiles(self):
+        """ Drop the tiles that are not within a tile of the visible part
+            of the control, nearby ones are kept for scrolling """
+        tile = self.TILE
+        keep = self._visible().Inflate(tile, tile)
+        for (column, row) in list(self.tiles):
+            if not keep.Intersects(wx.Rect(column * tile, row * tile,
+                                           tile, tile)):
+                del self.tiles[(column, row)]
+
     @classmethod
     def _32to16(cls, val):
         """ Helper function used by lower_to_bit_depth """
@@ -71,29 +189,30 @@ class DrawControl(wx.Control):
         base = val >> 6
         return (base << 6) + (base << 4) + (base << 2) + base
 
+    @classmethod
+    def _depth_table(cls, depth):
+        """ The 256 byte table mapping every sample value the way
+            _32to16, _32to12 or _32to8 does, made once per depth """
+        if depth not in cls._depth_tables:
+            method = getattr(cls, "_32to"+str(depth))
+            cls._depth_tables[depth] = bytes(method(val) for val in range(256))
+        return cls._depth_tables[depth]
+
     def lower_to_bit_depth(self, depth):
         """ Makes the image look like 16bit RGBA """
-        for x_pos in range(self.image_size[0]):
-            for y_pos in range(self.image_size[1]):
-                red = self.active_layer.GetRed(x_pos, y_pos)
-                green = self.active_layer.GetGreen(x_pos, y_pos)
-                blue = self.active_layer.GetBlue(x_pos, y_pos)
-                alpha = self.active_layer.GetAlpha(x_pos, y_pos)
-                method = getattr(self, "_32to"+str(depth))
-                red = method(red)
-                green = method(green)
-                blue = method(blue)
-                alpha = method(alpha)
-                self.active_layer.SetRGB(x_pos, y_pos, red, green, blue)
-                self.active_layer.SetAlpha(x_pos, y_pos, alpha)
+        # one pass over the red, green, blue and alpha bytes alike
+        data = self.active_layer.data
+        data[:] = data.translate(self._depth_table(depth))
+        self.active_layer.mark_dirty()
+        self.invalidate()
         self.Refresh(False)
 
     def set_image(self, img):
-        """ Start using / displaying the provided image """
+        """ Start using / displaying the provided canvas.Canvas """
         self.layers = [img]
         self.active_layer = img
-        size = img.GetSize()
-        self.image_size = (size.x, size.y)
+        self.image_size = (img.width, img.height)
+        self.invalidate()
         self.lower_to_bit_depth(12)
         self._resize()
 
@@ -107,49 +226,70 @@ class DrawControl(wx.Control):
     def on_paint(self, event):
         """ The onPaint handler function """
         paint_dc = wx.PaintDC(self)
-        graphics = wx.GraphicsContext.Create(paint_dc)
-        none_pen = graphics.CreatePen(wx.Pen(wx.Colour(0, 0, 0, 0)))
-        light_grey_brush = graphics.CreateBrush(wx.Brush((200, 200, 200, 255)))
-        dark_grey_brush = graphics.CreateBrush(wx.Brush((100, 100, 100, 255)))
-        graphics.SetPen(none_pen)
-
-        (width, height) = self.GetClientSize()
-        for x_pos in range(0, width, 20):
-            for y_pos in range(0, height, 20):
-                graphics.SetBrush(light_grey_brush)
-                graphics.DrawRectangle(x_pos, y_pos, 10, 10)
-                graphics.DrawRectangle(x_pos+10, y_pos+10, 10, 10)
-                graphics.SetBrush(dark_grey_brush)
-                graphics.DrawRectangle(x_pos+10, y_pos, 10, 10)
-                graphics.DrawRectangle(x_pos, y_pos+10, 10, 10)
-
-        (i_w, i_h) = self.image_size
-        paint_dc = wx.PaintDC(self)
-        paint_dc.DrawBitmap(
-            wx.Bitmap(self.active_layer.Scale(i_w * self.scale, i_h * self.scale)), 0, 0)
+        # draw in the coordinates of the whole scaled image
+        origin = self._origin()
+        paint_dc.SetDeviceOrigin(-origin.x, -origin.y)
+        box = self.GetUpdateRegion().GetBox()
+        update = wx.Rect(box.x + origin.x, box.y + origin.y,
+                         box.width, box.height)
+
+        # only render and copy the damaged part of the image, which is
+        # never more than what the control shows
+        (b_w, b_h) = (self.image_size[0] * self.scale,
+                      self.image_size[1] * self.scale)
+        damage = wx.Rect(0, 0, b_w, b_h).Intersect(update)
+        if not damage.IsEmpty():
+            self._prune_tiles()
+            mem_dc = wx.MemoryDC()
+            for (tile_rect, bitmap) in self._tiles(damage):
+                part = wx.Rect(tile_rect).Intersect(damage)
+                mem_dc.SelectObject(bitmap)
+                paint_dc.Blit(part.x, part.y, part.width, part.height, mem_dc,
+                              part.x - tile_rect.x, part.y - tile_rect.y)
+            mem_dc.SelectObject(wx.NullBitmap)
+        self._paint_border(paint_dc, update)
+
+    def _paint_border(self, paint_dc, update):
+        """ Helper function used by on_paint, the checkerboard shows in the
+            part of update that is in the border around the image """
+        (b_w, b_h) = (self.image_size[0] * self.scale,
+                      self.image_size[1] * self.scale)
+        paint_dc.SetPen(wx.TRANSPARENT_PEN)
+        paint_dc.SetBrush(clr.checkerboard())
+        visible = self._visible()
+        (width, height) = (visible.GetRight() + 1, visible.GetBottom() + 1)
+        for border in (wx.Rect(b_w, 0, width - b_w, height),
+                       wx.Rect(0, b_h, b_w, height - b_h)):
+            border = border.Intersect(update)
+            if not border.IsEmpty():
+                paint_dc.DrawRectangle(border)
 
     def on_click(self, event):
         """ Generic event handler for left, right, middle """
         scale = self.scale
-        pos = {"x": event.GetX() // scale, "y": event.GetY() // scale}
+        origin = self._origin()
+        pos = {"x": (event.GetX() + origin.x) // scale,
+               "y": (event.GetY() + origin.y) // scale}
         btn = "left"
         if event.RightIsDown():
             btn = "right"
-        self.window.tool.tool_down(self.active_layer, pos, btn)
-        self.Refresh(False)
+        changed = self.window.tool.tool_down(self.active_layer, pos, btn)
+        self.image_changed(changed)
 
     def on_motion(self, event):
         """ The onMotion handler function """
         scale = self.scale
-        pos = {"x": event.GetX() // scale, "y": event.GetY() // scale}
+        origin = self._origin()
+        pos = {"x": (event.GetX() + origin.x) // scale,
+               "y": (event.GetY() + origin.y) // scale}
         status = str(pos["x"]) + "," + str(pos["y"])
         self.window.status_bar.SetStatusText(status, 2)
         if event.Dragging():
             btn = "left"
             if event.RightIsDown():
                 btn = "right"
-            self.window.tool.tool_dragged(self.active_layer, pos, btn)
-            self.Refresh(False)
+            changed = self.window.tool.tool_dragged(self.active_layer, pos, btn)
+            self.image_changed(changed)
 
 
 #pylint: disable=too-few-public-methods
@@ -162,11 +302,9 @@ class DrawWindow(wx.ScrolledCanvas):
         wx.ScrolledCanvas.__init__(self, parent, wxid, pos, size, style, name)
 
         self.draw_control = DrawControl(self, parent)
-        sizer = wx.BoxSizer(wx.HORIZONTAL)
-        sizer.AddStretchSpacer()
-        sizer.Add(self.draw_control, 0, wx.CENTER)
-        sizer.AddStretchSpacer()
-        self.SetSizer(sizer)
+        # the scrollbars scroll what the DrawControl shows, instead of
+        # moving a DrawControl as big as the whole scaled image
+        self.SetTargetWindow(self.draw_control)
         self.SetMinSize((800, 600))
         self.ShowScrollbars(wx.SHOW_SB_ALWAYS, wx.SHOW_SB_ALWAYS)
 
@@ -224,8 +362,7 @@ class NewImageDialog(wx.Dialog):
         "What to do when they say yes to making a new image"
         width = int(self.width.GetValue())
         height = int(self.height.GetValue())
-        img = wx.Bitmap.ConvertToImage(
-            wx.Bitmap.FromRGBA(width, height, 0, 0, 0, 0))
+        img = canvas.Canvas(width, height)
         self.GetParent().draw_window.draw_control.set_image(img)
         self.Destroy()
 
@@ -398,9 +535,8 @@ class MainWindow(wx.Frame):
             self.dirname = dirname 
             os.chdir(dirname)
             img = wx.Image(os.path.join(dirname, filename))
-            if not img.HasAlpha():
-                img.InitAlpha()
-            self.draw_window.draw_control.set_image(img)
+            self.draw_window.draw_control.set_image(
+                canvas.Canvas.from_image(img))
         dlg.Destroy()
 
     #pylint: disable=unused-argument
@@ -415,19 +551,11 @@ class MainWindow(wx.Frame):
 
     def _save(self, filename):
         "general save handling code"
-        img = self.draw_window.draw_control.active_layer
-        data = list()
-
-        for y_pos in range(img.GetHeight()):
-            line = array("B")
-            for x_pos in range(img.GetWidth()):
-                line.append(img.GetRed(x_pos, y_pos))
-                line.append(img.GetGreen(x_pos, y_pos))
-                line.append(img.GetBlue(x_pos, y_pos))
-                line.append(img.GetAlpha(x_pos, y_pos))
-            data.append(line)
-
-        png.from_array(data, "RGBA;8").save(filename)
+        data = self.draw_window.draw_control.active_layer.rows()
+
+        # Art drawn with the 12-bit colour chooser rarely needs more
+        # than 256 colours, so is written colour mapped when possible.
+        png.from_array(data, "RGBA;8", indexed=True).save(filename)
         self.saved_at = self.command
 
     #pylint: disable=unused-argument
@@ -455,24 +583,24 @@ class MainWindow(wx.Frame):
     def on_undo(self, event):
         "on undo handler"
         if self.command.target != self:
-            self.command.revoke()
+            changed = self.command.revoke()
+            self.draw_window.draw_control.image_changed(changed)
             self.command = self.command.parent
             if self.command.target == self:
                 self.menu_undo.Enable(False)
             self.menu_redo.Enable(True)
-            self.draw_window.Refresh()
 
     #pylint: disable=unused-argument
     def on_redo(self, event):
         "on redo handler"
         if len(self.command.children) >= 1:
             child = self.command.children[-1]
-            child.invoke()
+            changed = child.invoke()
+            self.draw_window.draw_control.image_changed(changed)
             self.command = child
             if not child.children:
                 self.menu_redo.Enable(False)
             self.menu_undo.Enable(True)
-            self.draw_window.Refresh()
 
     #pylint: disable=unused-argument
     def on_zoom_in(self, event):
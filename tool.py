@@ -36,7 +36,8 @@ class Pencil(wx.Control):
         self.window.tool = self
 
     def tool_down(self, image, pos, btn):
-        "adds a pixel to the image and creates an undo command"
+        """adds a pixel to the image and creates an undo command,
+           returns the bounding box of the pixels changed"""
         if btn == "left":
             color = self.window.active_color.foreground
         elif btn == "right":
@@ -44,43 +45,50 @@ class Pencil(wx.Control):
         self.prev = pos
         # a new command everytime we click
         self.command = command.DrawCommand(image)
-        c_r = image.GetRed(pos["x"], pos["y"])
-        c_g = image.GetGreen(pos["x"], pos["y"])
-        c_b = image.GetBlue(pos["x"], pos["y"])
-        c_a = image.GetAlpha(pos["x"], pos["y"])
         self.command.add_pixel_mod(
-            command.PixelMod(pos, (c_r, c_g, c_b, c_a), color))
+            command.PixelMod(pos, image.get_pixel(pos["x"], pos["y"]), color))
         self.window.add_command(self.command)
-        self.command.invoke()
+        return self.command.invoke()
 
     def tool_dragged(self, image, pos, btn):
-        "draws a line when on the image, adds to the exisiting undo command"
+        """draws a line when on the image, adds to the exisiting undo command,
+           returns the bounding box of the pixels changed"""
         if btn == "left":
             color = self.window.active_color.foreground
         elif btn == "right":
             color = self.window.active_color.background
-        self.plot_line(image, color, self.prev, pos)
+        changed = self.plot_line(image, color, self.prev, pos)
         self.prev = pos
+        return changed
 
     def plot_line(self, image, color, pos0, pos1):
-        "Bresenham's line plotting algorithm as found on wikipedia"
+        """Bresenham's line plotting algorithm as found on wikipedia,
+           returns the bounding box of the pixels changed"""
         if abs(pos1["y"] - pos0["y"]) < abs(pos1["x"] - pos0["x"]):
             if pos0["x"] > pos1["x"]:
                 # pylint: disable=arguments-out-of-order
-                self.plot_line_low(image, color, pos1, pos0)
+                added = self.plot_line_low(image, color, pos1, pos0)
             else:
-                self.plot_line_low(image, color, pos0, pos1)
+                added = self.plot_line_low(image, color, pos0, pos1)
         else:
             if pos0["y"] > pos1["y"]:
                 # pylint: disable=arguments-out-of-order
-                self.plot_line_high(image, color, pos1, pos0)
+                added = self.plot_line_high(image, color, pos1, pos0)
             else:
-                self.plot_line_high(image, color, pos0, pos1)
-        # redraws the entire line so far (opportunity for optimization)
-        self.command.invoke()
+                added = self.plot_line_high(image, color, pos0, pos1)
+        # only the pixels new to the line so far need drawing
+        return self.command.apply(added)
+
+    def plot_pixel(self, image, color, x_pos, y_pos):
+        "helper function for plot_line, returns the PixelMod if added"
+        pos = {"x": x_pos, "y": y_pos}
+        mod = command.PixelMod(pos, image.get_pixel(x_pos, y_pos), color)
+        if self.command.add_pixel_mod(mod):
+            return mod
+        return None
 
     def plot_line_low(self, image, color, pos0, pos1):
-        "helper function for plot_line"
+        "helper function for plot_line, returns the PixelMods added"
         delta_x = pos1["x"] - pos0["x"]
         delta_y = pos1["y"] - pos0["y"]
         y_increment = 1
@@ -89,25 +97,22 @@ class Pencil(wx.Control):
             delta_y = -delta_y
         d_delta = 2*delta_y - delta_x
         y_pos = pos0["y"]
-        width = image.GetWidth()
-        height = image.GetHeight()
+        added = []
 
         for x_pos in range(pos0["x"], pos1["x"] + 1):
-            if x_pos < 0 or x_pos >= width or y_pos < 0 or y_pos >= height:
+            if not image.contains(x_pos, y_pos):
                 continue
-            pos = {"x": x_pos, "y": y_pos}
-            self.command.add_pixel_mod(
-                command.PixelMod(pos, (image.GetRed(x_pos, y_pos),
-                                       image.GetGreen(x_pos, y_pos),
-                                       image.GetBlue(x_pos, y_pos),
-                                       image.GetAlpha(x_pos, y_pos)), color))
+            mod = self.plot_pixel(image, color, x_pos, y_pos)
+            if mod is not None:
+                added.append(mod)
             if d_delta > 0:
                 y_pos = y_pos + y_increment
                 d_delta = d_delta - 2*delta_x
             d_delta = d_delta + 2*delta_y
+        return added
 
     def plot_line_high(self, image, color, pos0, pos1):
-        "helper function for plot_line"
+        "helper function for plot_line, returns the PixelMods added"
         delta_x = pos1["x"] - pos0["x"]
         delta_y = pos1["y"] - pos0["y"]
         x_increment = 1
@@ -116,22 +121,19 @@ class Pencil(wx.Control):
             delta_x = -delta_x
         d_delta = 2*delta_x - delta_y
         x_pos = pos0["x"]
-        width = image.GetWidth()
-        height = image.GetHeight()
+        added = []
 
         for y_pos in range(pos0["y"], pos1["y"] + 1):
-            if x_pos < 0 or x_pos >= width or y_pos < 0 or y_pos >= height:
+            if not image.contains(x_pos, y_pos):
                 continue
-            pos = {"x": x_pos, "y": y_pos}
-            self.command.add_pixel_mod(
-                command.PixelMod(pos, (image.GetRed(x_pos, y_pos),
-                                       image.GetGreen(x_pos, y_pos),
-                                       image.GetBlue(x_pos, y_pos),
-                                       image.GetAlpha(x_pos, y_pos)), color))
+            mod = self.plot_pixel(image, color, x_pos, y_pos)
+            if mod is not None:
+                added.append(mod)
             if d_delta > 0:
                 x_pos = x_pos + x_increment
                 d_delta = d_delta - 2*delta_y
             d_delta = d_delta + 2*delta_x
+        return added
 
 
 class BucketFill(wx.Control):
@@ -162,24 +164,19 @@ class BucketFill(wx.Control):
         self.window.draw_window.SetCursor(wx.Cursor(wx.CURSOR_SPRAYCAN))
         self.window.tool = self
 
-    # pylint: disable=too-many-locals
     def tool_down(self, image, pos, btn):
         """bucket fill when image is clicked,
-           breadth first search fill all pixels of the same color"""
+           breadth first search fill all pixels of the same color,
+           returns the bounding box of the pixels changed"""
         if btn == "left":
             color = self.window.active_color.foreground
         elif btn == "right":
             color = self.window.active_color.background
         # a new command everytime we click
         self.command = command.DrawCommand(image)
-        red = image.GetRed(pos["x"], pos["y"])
-        green = image.GetGreen(pos["x"], pos["y"])
-        blue = image.GetBlue(pos["x"], pos["y"])
-        alpha = image.GetAlpha(pos["x"], pos["y"])
+        target = image.get_pixel(pos["x"], pos["y"])
         self.window.add_command(self.command)
         # breath first search replacing all surrounding pixels with the same color
-        width = image.GetWidth()
-        height = image.GetHeight()
         queue = deque([(pos["x"], pos["y"])])
         done = {}
         while queue:
@@ -187,52 +184,37 @@ class BucketFill(wx.Control):
             (x_pos, y_pos) = lookat
             pos = {"x": x_pos, "y": y_pos}
             self.command.add_pixel_mod(
-                command.PixelMod(pos, (red, green, blue, alpha), color))
+                command.PixelMod(pos, target, color))
             done[lookat] = True
             # check pixel above
             if ((x_pos, y_pos - 1) not in done
-                    and width > x_pos >= 0
-                    and height > y_pos - 1 >= 0
-                    and red == image.GetRed(x_pos, y_pos - 1)
-                    and green == image.GetGreen(x_pos, y_pos - 1)
-                    and blue == image.GetBlue(x_pos, y_pos - 1)
-                    and alpha == image.GetAlpha(x_pos, y_pos - 1)):
+                    and image.contains(x_pos, y_pos - 1)
+                    and target == image.get_pixel(x_pos, y_pos - 1)):
                 queue.append((x_pos, y_pos - 1))
                 done[(x_pos, y_pos - 1)] = True
             # check pixel to the right
             if ((x_pos + 1, y_pos) not in done
-                    and width > x_pos + 1 >= 0
-                    and height > y_pos >= 0
-                    and red == image.GetRed(x_pos + 1, y_pos)
-                    and green == image.GetGreen(x_pos + 1, y_pos)
-                    and blue == image.GetBlue(x_pos + 1, y_pos)
-                    and alpha == image.GetAlpha(x_pos + 1, y_pos)):
+                    and image.contains(x_pos + 1, y_pos)
+                    and target == image.get_pixel(x_pos + 1, y_pos)):
                 queue.append((x_pos + 1, y_pos))
                 done[(x_pos + 1, y_pos)] = True
             # check pixel below
             if ((x_pos, y_pos + 1) not in done
-                    and width > x_pos >= 0
-                    and height > y_pos + 1 >= 0
-                    and red == image.GetRed(x_pos, y_pos + 1)
-                    and green == image.GetGreen(x_pos, y_pos + 1)
-                    and blue == image.GetBlue(x_pos, y_pos + 1)
-                    and alpha == image.GetAlpha(x_pos, y_pos + 1)):
+                    and image.contains(x_pos, y_pos + 1)
+                    and target == image.get_pixel(x_pos, y_pos + 1)):
                 queue.append((x_pos, y_pos + 1))
                 done[(x_pos, y_pos + 1)] = True
             # check pixel to the left
             if ((x_pos - 1, y_pos) not in done
-                    and width > x_pos - 1 >= 0
-                    and height > y_pos >= 0
-                    and red == image.GetRed(x_pos - 1, y_pos)
-                    and green == image.GetGreen(x_pos - 1, y_pos)
-                    and blue == image.GetBlue(x_pos - 1, y_pos)
-                    and alpha == image.GetAlpha(x_pos - 1, y_pos)):
+                    and image.contains(x_pos - 1, y_pos)
+                    and target == image.get_pixel(x_pos - 1, y_pos)):
                 queue.append((x_pos - 1, y_pos))
                 done[(x_pos - 1, y_pos)] = True
-        self.command.invoke()
+        return self.command.invoke()
 
     def tool_dragged(self, image, pos, btn):
         "no functionality for dragging bucket fill"
+        return None
 
 
 class ColorPicker(wx.Control):
@@ -264,12 +246,8 @@ class ColorPicker(wx.Control):
         self.window.tool = self
 
     def tool_down(self, image, pos, btn):
-        "pick color from image into FG or BG"
-        c_r = image.GetRed(pos["x"], pos["y"])
-        c_g = image.GetGreen(pos["x"], pos["y"])
-        c_b = image.GetBlue(pos["x"], pos["y"])
-        c_a = image.GetAlpha(pos["x"], pos["y"])
-        color = [c_r, c_g, c_b, c_a]
+        "pick color from image into FG or BG, the image is unchanged so no box"
+        color = list(image.get_pixel(pos["x"], pos["y"]))
         if btn == "left":
             self.window.active_color.foreground = color
             self.window.fg_picker.update_color(color)
@@ -279,6 +257,7 @@ class ColorPicker(wx.Control):
 
     def tool_dragged(self, image, pos, btn):
         "no functionality for dragging color picker"
+        return None
 
 
 